@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+
+import metrics
+from resilience import remaining
+
+# Controle de admissão na frente do Stripe: token bucket na taxa da conta, com
+# fila de espera limitada e por prioridade (checkout/upsell na frente de
+# webhook, que fica na frente de reconciliação/seed). Um 429 derruba a taxa
+# pela metade, que volta aos poucos. Quem não caberia no orçamento de espera
+# da sua prioridade é recusado na hora com Overloaded (503 + Retry-After).
+STRIPE_RATE          = float(os.getenv("STRIPE_RATE", "80"))      # req/s
+STRIPE_BURST         = float(os.getenv("STRIPE_BURST", str(STRIPE_RATE)))
+STRIPE_QUEUE_MAX     = int(os.getenv("STRIPE_QUEUE_MAX", "1000"))
+# espera máxima (s) por prioridade: interactive, webhook, background
+STRIPE_QUEUE_BUDGETS = tuple(float(x) for x in os.getenv("STRIPE_QUEUE_BUDGETS", "2,10,120").split(","))
+
+INTERACTIVE, WEBHOOK, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "webhook", "background")
+
+# prioridade do contexto atual; sem nada definido = webhook
+_priority = contextvars.ContextVar("priority", default=WEBHOOK)
+
+
+def set_priority(priority: int):
+    return _priority.set(priority)
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"stripe admission queue over budget, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, rate: float = STRIPE_RATE, burst: float = STRIPE_BURST,
+                 max_queue: int = STRIPE_QUEUE_MAX, budgets: tuple = STRIPE_QUEUE_BUDGETS):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = max(1.0, rate / 16)
+        self.burst = burst
+        self.tokens = burst
+        self.max_queue = max_queue
+        self.budgets = budgets
+        self.admitted = 0
+        self.throttles = 0
+        self.shed = [0, 0, 0]
+        self._waiting = [0, 0, 0]
+        self._heap = []
+        self._seq = itertools.count()
+        self._at = time.monotonic()
+        self._pump_task = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._at = now - self._at, now
+        # depois de um 429 a taxa volta ao normal em ~20s
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05 * elapsed)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    async def acquire(self, priority: int = None):
+        priority = _priority.get() if priority is None else priority
+        self._refill()
+        if not self._heap and self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+            return
+
+        # estimativa: quem está na frente (mesma prioridade ou maior) / taxa
+        ahead = sum(self._waiting[:priority + 1])
+        wait = (ahead + 1 - self.tokens) / self.rate
+        # nunca espera além do deadline do request
+        budget = remaining(self.budgets[priority])
+        if len(self._heap) >= self.max_queue or wait > budget:
+            raise self._shed(priority, wait)
+
+        t0 = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), fut))
+        self._waiting[priority] += 1
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        try:
+            await asyncio.wait_for(fut, budget)
+        except asyncio.TimeoutError:
+            raise self._shed(priority, budget) from None
+        self.admitted += 1
+        metrics.admission_wait.observe(time.perf_counter() - t0, PRIORITY_NAMES[priority])
+
+    def _shed(self, priority: int, wait: float) -> Overloaded:
+        self.shed[priority] += 1
+        metrics.admission_shed.inc(PRIORITY_NAMES[priority])
+        return Overloaded(max(wait, 1.0))
+
+    def throttled(self):
+        # 429 do Stripe: metade da taxa e zera o balde
+        self.throttles += 1
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    async def _pump(self):
+        try:
+            while self._heap:
+                self._refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    continue
+                priority, _, fut = heapq.heappop(self._heap)
+                self._waiting[priority] -= 1
+                if fut.done():          # desistiu (timeout/cancelado)
+                    continue
+                self.tokens -= 1
+                fut.set_result(None)
+        finally:
+            self._pump_task = None
+
+    def stats(self) -> dict:
+        return {
+            "rate":      round(self.rate, 1),
+            "base_rate": self.base_rate,
+            "queued":    dict(zip(PRIORITY_NAMES, self._waiting)),
+            "admitted":  self.admitted,
+            "throttles": self.throttles,
+            "shed":      dict(zip(PRIORITY_NAMES, self.shed)),
+        }
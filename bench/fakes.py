@@ -0,0 +1,262 @@
+# Stand-ins locais p/ as dependências externas do main.py, num processo só:
+#
+#   /v1/...                      API do Stripe (estilo stripe-mock, estado em memória)
+#   /v14.0/{pixel}/events        Graph API (Conversions API)
+#   /utmify/orders               UTMify
+#   /paypal/ipn                  verificação de IPN do PayPal (responde VERIFIED)
+#
+#   python -m bench.fakes --port 12111 --latency stripe=40,graph=120 --errors utmify=0.02
+#
+# Latência (ms) e taxa de erro são por dependência; a latência real sorteada
+# fica entre 0.5x e 1.5x do valor pedido. Erros viram 500 (Stripe no formato
+# de erro da API) para exercitar retry, breaker e outbox.
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import urllib.parse
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+DEPENDENCIES = ("stripe", "graph", "utmify", "paypal")
+
+# catálogo fixo usado pelo bench/load.py
+PRICES = {
+    "price_bench_main":   {"unit_amount": 4700, "nickname": "Principal", "product": "prod_bench_main", "name": "Curso"},
+    "price_bench_upsell": {"unit_amount": 1990, "nickname": "Upsell",    "product": "prod_bench_upsell", "name": "Bônus"},
+}
+
+
+def parse_spec(spec: str, cast=float) -> dict:
+    # "stripe=40,graph=120" -> {"stripe": 40.0, "graph": 120.0}
+    out = {}
+    for item in filter(None, (s.strip() for s in (spec or "").split(","))):
+        name, _, value = item.partition("=")
+        out[name.strip()] = cast(value)
+    return out
+
+
+def _nested(pairs) -> dict:
+    # form do SDK do Stripe: metadata[utm_source]=x, line_items[0][price]=y
+    out = {}
+    for key, value in pairs:
+        parts = key.replace("]", "").split("[")
+        node = out
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return out
+
+
+def _price(price_id: str) -> dict:
+    p = PRICES.get(price_id) or {"unit_amount": 1000, "nickname": None, "product": "prod_x", "name": price_id}
+    return {
+        "id": price_id, "object": "price", "active": True, "currency": "usd",
+        "unit_amount": p["unit_amount"], "nickname": p["nickname"],
+        "product": {"id": p["product"], "object": "product", "name": p["name"], "active": True},
+    }
+
+
+def _list(url: str, data: list) -> dict:
+    return {"object": "list", "url": url, "has_more": False, "data": data}
+
+
+def create_app(latency: dict = None, errors: dict = None) -> FastAPI:
+    latency = {k: v / 1000 for k, v in (latency or {}).items()}
+    errors = errors or {}
+    ids = itertools.count(1)
+    sessions, customers, intents, idempotent = {}, {}, {}, {}
+    app = FastAPI()
+    app.state.hits = {name: 0 for name in DEPENDENCIES}
+
+    def new_id(prefix: str) -> str:
+        return f"{prefix}_bench{next(ids):08d}"
+
+    async def inject(dep: str):
+        # devolve uma resposta de erro ou None
+        app.state.hits[dep] += 1
+        base = latency.get(dep, 0.0)
+        if base:
+            await asyncio.sleep(base * random.uniform(0.5, 1.5))
+        if random.random() < errors.get(dep, 0.0):
+            if dep == "stripe":
+                return JSONResponse(status_code=500, content={"error": {"type": "api_error", "message": "injected"}})
+            return JSONResponse(status_code=500, content={"error": "injected"})
+        return None
+
+    async def form(request: Request) -> dict:
+        return _nested(urllib.parse.parse_qsl((await request.body()).decode()))
+
+    # ── Stripe ──────────────────────────────────────────────────────
+    @app.post("/v1/checkout/sessions")
+    async def create_session(request: Request):
+        if (err := await inject("stripe")) is not None:
+            return err
+        params = await form(request)
+        item = params.get("line_items", {}).get("0", {})
+        price = _price(item.get("price", ""))
+        quantity = int(item.get("quantity", 1))
+        sid = new_id("cs")
+        sessions[sid] = {
+            "id": sid, "object": "checkout.session", "status": "open", "mode": "payment",
+            "url": f"https://checkout.stripe.test/c/pay/{sid}",
+            "currency": price["currency"],
+            "amount_subtotal": price["unit_amount"] * quantity,
+            "amount_total": price["unit_amount"] * quantity,
+            "metadata": params.get("metadata", {}),
+            "customer": None, "customer_details": None, "payment_intent": None,
+            "created": int(time.time()),
+        }
+        return sessions[sid]
+
+    @app.get("/v1/checkout/sessions/{sid}")
+    async def retrieve_session(sid: str):
+        if (err := await inject("stripe")) is not None:
+            return err
+        session = sessions.get(sid)
+        if session is None:
+            return JSONResponse(status_code=404, content={"error": {"type": "invalid_request_error", "message": f"No such checkout.session: '{sid}'"}})
+        return session
+
+    @app.get("/v1/checkout/sessions")
+    async def list_sessions():
+        if (err := await inject("stripe")) is not None:
+            return err
+        return _list("/v1/checkout/sessions", list(sessions.values())[-100:])
+
+    @app.get("/v1/prices/{price_id}")
+    async def retrieve_price(price_id: str):
+        if (err := await inject("stripe")) is not None:
+            return err
+        return _price(price_id)
+
+    @app.get("/v1/prices")
+    async def list_prices():
+        if (err := await inject("stripe")) is not None:
+            return err
+        return _list("/v1/prices", [_price(p) for p in PRICES])
+
+    @app.post("/v1/customers")
+    async def create_customer(request: Request):
+        if (err := await inject("stripe")) is not None:
+            return err
+        params = await form(request)
+        cid = new_id("cus")
+        customers[cid] = {"id": cid, "object": "customer", "email": params.get("email"),
+                          "name": None, "phone": None, "metadata": params.get("metadata", {}),
+                          "created": int(time.time())}
+        return customers[cid]
+
+    @app.get("/v1/customers")
+    async def list_customers():
+        if (err := await inject("stripe")) is not None:
+            return err
+        return _list("/v1/customers", list(customers.values())[-100:])
+
+    @app.get("/v1/customers/{cid}")
+    async def retrieve_customer(cid: str):
+        if (err := await inject("stripe")) is not None:
+            return err
+        return customers.get(cid) or {"id": cid, "object": "customer", "email": None,
+                                      "name": None, "phone": None, "metadata": {},
+                                      "created": int(time.time())}
+
+    @app.post("/v1/customers/{cid}")
+    async def update_customer(cid: str, request: Request):
+        if (err := await inject("stripe")) is not None:
+            return err
+        customer = customers.setdefault(cid, {"id": cid, "object": "customer", "email": None,
+                                              "name": None, "phone": None, "metadata": {},
+                                              "created": int(time.time())})
+        customer.update(await form(request))
+        return customer
+
+    @app.post("/v1/payment_intents")
+    async def create_intent(request: Request):
+        if (err := await inject("stripe")) is not None:
+            return err
+        key = request.headers.get("idempotency-key")
+        if key and key in idempotent:
+            return intents[idempotent[key]]
+        params = await form(request)
+        pid = new_id("pi")
+        intents[pid] = {
+            "id": pid, "object": "payment_intent", "status": "requires_confirmation",
+            "client_secret": f"{pid}_secret_bench",
+            "amount": int(params.get("amount", 0)), "currency": params.get("currency", "usd"),
+            "customer": params.get("customer"), "payment_method": params.get("payment_method"),
+            "metadata": params.get("metadata", {}), "created": int(time.time()),
+            "latest_charge": None,
+        }
+        if key:
+            idempotent[key] = pid
+        return intents[pid]
+
+    @app.get("/v1/payment_intents")
+    async def list_intents():
+        if (err := await inject("stripe")) is not None:
+            return err
+        return _list("/v1/payment_intents", list(intents.values())[-100:])
+
+    @app.get("/v1/payment_intents/{pid}")
+    async def retrieve_intent(pid: str):
+        if (err := await inject("stripe")) is not None:
+            return err
+        return intents.get(pid) or {"id": pid, "object": "payment_intent", "status": "succeeded",
+                                    "payment_method": "pm_bench", "latest_charge": None,
+                                    "metadata": {}, "amount": 0, "currency": "usd"}
+
+    @app.post("/v1/payment_intents/{pid}/cancel")
+    async def cancel_intent(pid: str):
+        if (err := await inject("stripe")) is not None:
+            return err
+        intent = intents.setdefault(pid, {"id": pid, "object": "payment_intent"})
+        intent["status"] = "canceled"
+        return intent
+
+    # ── Graph API / UTMify / PayPal ─────────────────────────────────
+    @app.post("/{version}/{pixel}/events")
+    async def capi_events(request: Request):
+        if (err := await inject("graph")) is not None:
+            return err
+        body = await request.json()
+        return {"events_received": len(body.get("data", [])), "fbtrace_id": "bench"}
+
+    @app.post("/utmify/orders")
+    async def utmify_orders(request: Request):
+        if (err := await inject("utmify")) is not None:
+            return err
+        await request.body()
+        return {"OK": True}
+
+    @app.post("/paypal/ipn")
+    async def paypal_ipn(request: Request):
+        if (err := await inject("paypal")) is not None:
+            return err
+        await request.body()
+        return Response("VERIFIED", media_type="text/plain")
+
+    @app.get("/_hits")
+    async def hits():
+        return app.state.hits
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", default="", help="ms por dependência: stripe=40,graph=120")
+    parser.add_argument("--errors", default="", help="taxa de erro: utmify=0.02")
+    args = parser.parse_args()
+    app = create_app(parse_spec(args.latency), parse_spec(args.errors))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+# Gerador de carga do funil contra o app real (uvicorn main:app) apontado para
+# os fakes de bench/fakes.py. Mistura checkout, upsell 1-click, webhooks
+# assinados (checkout.session.completed, payment_intent.succeeded, retries
+# duplicados) e IPNs do PayPal, e reporta p50/p95/p99 e RPS por endpoint.
+#
+#   python -m bench.load --duration 20 --concurrency 32 \
+#       --mix checkout=40,upsell=20,webhook=35,ipn=5 \
+#       --latency stripe=40,graph=120,utmify=80,paypal=150 --out base.json
+#
+#   # depois da mudança, no outro commit:
+#   python -m bench.load ... --out new.json --compare base.json
+#
+# --app-env KEY=VALUE repassa env p/ o app (ex.: WEBHOOK_ASYNC=1);
+# --app-url usa um app já rodando em vez de subir um.
+#
+# Subindo o app, mede também o cold start: tempo até aceitar conexões, até o
+# /ready e até o primeiro checkout abaixo de --fast-ms (o primeiro comprador
+# depois do restart diário do dyno).
+#
+# No fim confere o /outbox do app: entrega de tracking falhando sem --errors
+# (env do app incompleto, ex.: sem UTMIFY_API_KEY) invalida a execução, porque
+# os números medidos não são os do caminho feliz.
+import argparse
+import asyncio
+import collections
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.fakes import parse_spec
+
+WEBHOOK_SECRET = "whsec_bench"
+MAIN_PRICE     = "price_bench_main"
+UPSELL_PRICE   = "price_bench_upsell"
+DUPLICATE_RATE = 0.05          # fração de webhooks reentregues (retry do Stripe)
+_checkouts     = itertools.count(1)
+
+
+def checkout_body() -> dict:
+    # cada checkout é de um comprador diferente (email e token próprios): o
+    # single-flight não pode transformar a carga em cache hits
+    n = next(_checkouts)
+    return {"price_id": MAIN_PRICE, "quantity": 1, "customer_email": f"bench+{n}@example.com",
+            "idempotency_key": f"bench-{os.getpid()}-{n}",
+            "utm_source": "fb", "utm_medium": "cpc", "utm_campaign": "bench"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn(args: list, env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", *args], env={**os.environ, **(env or {})})
+
+
+async def wait_up(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} não subiu em {timeout:.0f}s")
+
+
+def signed(event: dict) -> dict:
+    body = json.dumps(event)
+    ts = int(time.time())
+    sig = hmac.new(WEBHOOK_SECRET.encode(), f"{ts}.{body}".encode(), hashlib.sha256).hexdigest()
+    return {"content": body, "headers": {"stripe-signature": f"t={ts},v1={sig}",
+                                         "Content-Type": "application/json"}}
+
+
+def stripe_event(type: str, obj: dict) -> dict:
+    return {"id": "evt_" + os.urandom(8).hex(), "object": "event", "type": type,
+            "created": int(time.time()), "data": {"object": obj}}
+
+
+class Funnel:
+    # estado compartilhado entre os workers: sessões abertas, pagas e upsells
+    # aguardando o payment_intent.succeeded
+    def __init__(self):
+        self.opened = collections.deque(maxlen=10000)
+        self.paid = collections.deque(maxlen=10000)
+        self.upsells = collections.deque(maxlen=10000)
+        self.delivered = collections.deque(maxlen=500)     # p/ reentregas
+        self.samples = collections.defaultdict(list)       # endpoint -> [(latência, status)]
+
+    async def record(self, endpoint: str, coro):
+        t0 = time.perf_counter()
+        try:
+            resp = await coro
+            status = resp.status_code
+        except httpx.HTTPError:
+            resp, status = None, 0
+        self.samples[endpoint].append((time.perf_counter() - t0, status))
+        return resp
+
+    async def checkout(self, client):
+        resp = await self.record("/create-checkout-session", client.post("/create-checkout-session", json=checkout_body()))
+        if resp is not None and resp.status_code == 200:
+            self.opened.append(resp.json()["checkout_url"].rsplit("/", 1)[-1])
+
+    async def session_completed(self, client):
+        sid = self.opened.popleft()
+        n = sid[-8:]
+        event = stripe_event("checkout.session.completed", {
+            "id": sid, "object": "checkout.session", "status": "complete",
+            "currency": "usd", "amount_total": 4700, "amount_subtotal": 4700,
+            "created": int(time.time()), "url": None,
+            "customer": f"cus_bench{n}", "payment_intent": f"pi_bench{n}",
+            "metadata": {"utm_source": "fb", "utm_medium": "cpc", "utm_campaign": "bench"},
+            "customer_details": {"email": "bench@example.com", "name": "Bench", "phone": "+5511999999999"},
+        })
+        # o PM do checkout chega pelo payment_intent.succeeded do próprio PI
+        await self.deliver(client, stripe_event("payment_intent.succeeded", {
+            "id": f"pi_bench{n}", "object": "payment_intent", "amount": 4700, "currency": "usd",
+            "created": int(time.time()), "customer": f"cus_bench{n}",
+            "payment_method": f"pm_bench{n}", "metadata": {},
+        }))
+        resp = await self.deliver(client, event)
+        if resp is not None and resp.status_code == 200:
+            self.paid.append(sid)
+
+    async def upsell(self, client):
+        sid = random.choice(self.paid)
+        resp = await self.record("/upsell/intent", client.post("/upsell/intent", json={
+            "sid": sid, "price_id": UPSELL_PRICE, "quantity": 1,
+        }))
+        if resp is not None and resp.status_code == 200:
+            self.upsells.append((resp.json()["intent_id"], sid))
+
+    async def upsell_succeeded(self, client):
+        intent_id, sid = self.upsells.popleft()
+        await self.deliver(client, stripe_event("payment_intent.succeeded", {
+            "id": intent_id, "object": "payment_intent", "amount": 1990, "currency": "usd",
+            "created": int(time.time()), "customer": None, "payment_method": "pm_bench",
+            "metadata": {"upsell": "true", "parent_session": sid, "price_id": UPSELL_PRICE,
+                         "quantity": "1", "utm_source": "fb"},
+        }))
+
+    async def deliver(self, client, event: dict):
+        resp = await self.record("/webhook", client.post("/webhook", **signed(event)))
+        self.delivered.append(event)
+        return resp
+
+    async def webhook(self, client):
+        if self.delivered and random.random() < DUPLICATE_RATE:
+            await self.record("/webhook", client.post("/webhook", **signed(random.choice(self.delivered))))
+        elif self.upsells:
+            await self.upsell_succeeded(client)
+        elif self.opened:
+            await self.session_completed(client)
+        else:
+            await self.checkout(client)
+
+    async def ipn(self, client):
+        txn = "TXN" + os.urandom(6).hex().upper()
+        await self.record("/track-paypal", client.post("/track-paypal", data={
+            "txn_id": txn, "payment_status": "Completed", "mc_gross": "47.00", "mc_currency": "USD",
+            "payer_email": "bench@example.com", "item_number": "curso", "item_name": "Curso",
+            "quantity": "1", "custom_utm_source": "fb",
+        }))
+
+    async def step(self, client, op: str):
+        if op == "upsell" and not self.paid:
+            op = "webhook"
+        await getattr(self, op)(client)
+
+
+async def wait_ready(client, spawned_at: float, timeout: float) -> float:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        resp = await client.get("/ready")
+        if resp.status_code == 404:         # app sem /ready
+            return None
+        if resp.status_code == 200:
+            return round(time.monotonic() - spawned_at, 3)
+        await asyncio.sleep(0.05)
+    return None
+
+
+async def cold_start(app_url: str, spawned_at: float, fast_ms: float, timeout: float = 30.0) -> dict:
+    # checkouts em sequência desde que o app aceita conexão até um sair rápido
+    await wait_up(app_url + "/health")
+    result = {"listening_s": round(time.monotonic() - spawned_at, 3), "first_request_ms": None,
+              "first_fast_s": None, "requests": 0}
+    async with httpx.AsyncClient(base_url=app_url, timeout=30) as client:
+        ready = asyncio.create_task(wait_ready(client, spawned_at, timeout))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            t0 = time.perf_counter()
+            resp = await client.post("/create-checkout-session", json=checkout_body())
+            ms = (time.perf_counter() - t0) * 1000
+            result["requests"] += 1
+            if result["first_request_ms"] is None:
+                result["first_request_ms"] = round(ms, 1)
+            if resp.status_code == 200 and ms <= fast_ms:
+                result["first_fast_s"] = round(time.monotonic() - spawned_at, 3)
+                break
+        result["ready_s"] = await ready
+    return result
+
+
+def print_cold_start(cold: dict):
+    def fmt(value, unit):
+        return "-" if value is None else f"{value}{unit}"
+    print(f"cold start: aceitando conexões em {fmt(cold['listening_s'], 's')}, /ready em {fmt(cold['ready_s'], 's')}, "
+          f"1º checkout {fmt(cold['first_request_ms'], ' ms')}, 1º checkout rápido em {fmt(cold['first_fast_s'], 's')} "
+          f"({cold['requests']} requests)")
+
+
+async def drive(app_url: str, mix: dict, duration: float, concurrency: int, warmup: float) -> Funnel:
+    funnel = Funnel()
+    ops, weights = zip(*mix.items())
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=30) as client:
+        async def worker(until: float):
+            while time.monotonic() < until:
+                await funnel.step(client, random.choices(ops, weights)[0])
+
+        if warmup:
+            await asyncio.gather(*(worker(time.monotonic() + warmup) for _ in range(concurrency)))
+            funnel.samples.clear()
+        t0 = time.monotonic()
+        await asyncio.gather(*(worker(t0 + duration) for _ in range(concurrency)))
+        funnel.elapsed = time.monotonic() - t0
+    return funnel
+
+
+async def delivery_stats(app_url: str) -> dict:
+    async with httpx.AsyncClient(base_url=app_url, timeout=10) as client:
+        stats = (await client.get("/outbox")).json()
+    return {k: stats[k] for k in ("delivered", "failed", "deferred", "dead", "depth")}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(funnel: Funnel) -> dict:
+    report = {}
+    for endpoint, samples in sorted(funnel.samples.items()):
+        latencies = sorted(s[0] for s in samples)
+        report[endpoint] = {
+            "count":  len(samples),
+            "errors": sum(1 for _, status in samples if not 200 <= status < 300),
+            "rps":    round(len(samples) / funnel.elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    return report
+
+
+def print_report(report: dict):
+    print(f"{'endpoint':<26}{'count':>8}{'errors':>8}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint, r in report.items():
+        print(f"{endpoint:<26}{r['count']:>8}{r['errors']:>8}{r['rps']:>8}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+
+
+def compare(report: dict, baseline: dict, threshold: float, cold: dict = None) -> bool:
+    # True se algum endpoint piorou p95 (ou RPS) além do threshold
+    regressed = False
+    print(f"\n{'endpoint':<26}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}   vs {baseline.get('commit', '?')}")
+    for endpoint, r in report.items():
+        base = baseline["endpoints"].get(endpoint)
+        if base is None:
+            continue
+        delta = {k: (r[k] - base[k]) / base[k] if base[k] else 0.0
+                 for k in ("p50_ms", "p95_ms", "p99_ms", "rps")}
+        bad = delta["p95_ms"] > threshold or delta["rps"] < -threshold
+        regressed |= bad
+        print(f"{endpoint:<26}" + "".join(f"{delta[k]:>+10.1%}" for k in ("p50_ms", "p95_ms", "p99_ms", "rps"))
+              + ("   REGRESSÃO" if bad else ""))
+    cold, base = cold or {}, baseline.get("cold_start") or {}
+    if cold.get("first_fast_s") and base.get("first_fast_s"):
+        delta = (cold["first_fast_s"] - base["first_fast_s"]) / base["first_fast_s"]
+        bad = delta > threshold
+        regressed |= bad
+        print(f"{'cold start (1º rápido)':<26}{delta:>+10.1%}" + ("   REGRESSÃO" if bad else ""))
+    return regressed
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "?"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default="checkout=40,upsell=20,webhook=35,ipn=5")
+    parser.add_argument("--latency", default="stripe=40,graph=120,utmify=80,paypal=150",
+                        help="latência injetada (ms) por dependência")
+    parser.add_argument("--errors", default="", help="taxa de erro injetada: utmify=0.05")
+    parser.add_argument("--app-url", default="", help="app já rodando (não sobe fakes nem app)")
+    parser.add_argument("--app-env", action="append", default=[], help="KEY=VALUE repassado ao app")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="")
+    parser.add_argument("--compare", default="", help="JSON de uma execução anterior")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--fast-ms", type=float, default=150, help="checkout abaixo disso conta como rápido (cold start)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    mix = parse_spec(args.mix)
+
+    procs = []
+    app_url = args.app_url
+    cold = None
+    try:
+        if not app_url:
+            fake_port, app_port = free_port(), free_port()
+            fake_url = f"http://127.0.0.1:{fake_port}"
+            procs.append(spawn(["bench.fakes", "--port", str(fake_port),
+                                "--latency", args.latency, "--errors", args.errors]))
+            env = {
+                "STRIPE_SECRET_KEY":     "sk_test_bench",
+                "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+                "STRIPE_API_BASE":       fake_url,
+                "GRAPH_API_URL":         fake_url,
+                "UTMIFY_API_URL":        fake_url + "/utmify/orders",
+                "UTMIFY_API_KEY":        "bench",
+                "PAYPAL_IPN_URL":        fake_url + "/paypal/ipn",
+                "PIXEL_ID":              "bench",
+                "ACCESS_TOKEN":          "bench",
+                "DATA_DIR":              tempfile.mkdtemp(prefix="bench-data-"),
+                **dict(kv.split("=", 1) for kv in args.app_env),
+            }
+            asyncio.run(wait_up(fake_url + "/_hits"))
+            spawned_at = time.monotonic()
+            procs.append(spawn(["uvicorn", "main:app", "--port", str(app_port),
+                                "--log-level", "warning"], env))
+            app_url = f"http://127.0.0.1:{app_port}"
+            cold = asyncio.run(cold_start(app_url, spawned_at, args.fast_ms))
+        else:
+            asyncio.run(wait_up(app_url + "/health"))
+
+        funnel = asyncio.run(drive(app_url, mix, args.duration, args.concurrency, args.warmup))
+        delivery = asyncio.run(delivery_stats(app_url))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+    report = summarize(funnel)
+    print_report(report)
+    if cold:
+        print_cold_start(cold)
+    print("entregas:", delivery)
+    valid = bool(args.errors) or not (delivery["failed"] or delivery["deferred"] or delivery["dead"])
+    if not valid:
+        print("⚠️ entregas de tracking falharam sem erro injetado: execução inválida (confira o env do app)")
+    result = {"commit": git_commit(), "args": vars(args), "endpoints": report, "cold_start": cold,
+              "delivery": delivery, "valid": valid}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not baseline.get("valid", True):
+            print(f"⚠️ baseline {baseline.get('commit', '?')} marcado como inválido")
+        if compare(report, baseline, args.threshold, cold):
+            sys.exit(1)
+    if not valid:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Antes/depois do pool HTTP assíncrono: dispara N "checkouts" concorrentes,
+# cada um fazendo os dois POSTs de tracking (CAPI + UTMify) contra um sink
+# local com latência injetada, e mede o atraso do event loop enquanto isso.
+#
+#   python -m bench.loop_blocking --concurrency 50 --latency-ms 150
+#
+# "before" usa requests.post dentro de async (como main.py fazia), "after"
+# usa o HttpPool compartilhado.
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from http_pool import HttpPool
+
+
+def start_sink(latency: float) -> ThreadingHTTPServer:
+    class Sink(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(latency)
+            body = b'{"events_received":1}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 256
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Sink)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def probe_lag(samples: list, stop: asyncio.Event, interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t0 - interval))
+
+
+async def run(mode: str, url: str, concurrency: int) -> dict:
+    pool = HttpPool()
+    payload = {"data": [{"event_name": "InitiateCheckout", "event_id": "cs_bench"}]}
+
+    async def checkout_before():
+        requests.post(url + "/capi", json=payload)
+        requests.post(url + "/utmify", json=payload)
+
+    async def checkout_after():
+        await pool.post(url + "/capi", json=payload)
+        await pool.post(url + "/utmify", json=payload)
+
+    handler = checkout_before if mode == "before" else checkout_after
+    lag: list = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe_lag(lag, stop))
+    await asyncio.sleep(0.05)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+
+    stop.set()
+    await prober
+    await pool.aclose()
+    lag.sort()
+    return {
+        "mode":        mode,
+        "wall_s":      round(wall, 3),
+        "lag_max_ms":  round(lag[-1] * 1000, 1) if lag else 0.0,
+        "lag_p99_ms":  round(lag[int(len(lag) * 0.99) - 1] * 1000, 1) if lag else 0.0,
+        "lag_mean_ms": round(statistics.mean(lag) * 1000, 1) if lag else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    args = parser.parse_args()
+
+    server = start_sink(args.latency_ms / 1000)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        for mode in ("before", "after"):
+            print(asyncio.run(run(mode, url, args.concurrency)))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Antes/depois do modelo de pedido: monta N pedidos pagos (UTMify) + eventos
+# Purchase (CAPI) como main.py fazia (dicts + json.dumps a cada tentativa)
+# e com os modelos com slots + orjson serializados uma vez só.
+#
+#   python -m bench.order_model --orders 20000 --attempts 3
+#
+# "attempts" simula as retentativas do outbox: antes o payload era
+# re-encodado a cada envio, agora os bytes são reaproveitados.
+import argparse
+import json
+import time
+import tracemalloc
+from decimal import Decimal
+
+from models import Order, TrackingEvent, Customer, Product, tracking_parameters, utc
+
+META = {"utm_source": "fb", "utm_medium": "cpc", "utm_campaign": "black", "utm_term": "", "utm_content": "ad1"}
+LINE_ITEM = {"price_id": "price_123", "name": "Curso", "nickname": "Plano anual",
+             "quantity": 1, "amount_subtotal": 19700}
+
+
+def before(i: int, attempts: int) -> int:
+    total = 19700
+    fee = (Decimal(total) * Decimal("0.0674")).quantize(Decimal("1"))
+    order = {
+        "orderId": f"cs_{i}", "platform": "Stripe", "paymentMethod": "credit_card",
+        "status": "paid", "createdAt": utc(), "approvedDate": utc(), "refundedAt": None,
+        "customer": {"name": "Fulano", "email": "f@x.com", "phone": None, "document": None},
+        "products": [{"id": LINE_ITEM["price_id"], "name": LINE_ITEM["name"],
+                      "planId": LINE_ITEM["price_id"], "planName": LINE_ITEM["nickname"],
+                      "quantity": 1, "priceInCents": total}],
+        "trackingParameters": {k: META.get(k) for k in META},
+        "commission": {"totalPriceInCents": total, "gatewayFeeInCents": int(fee),
+                       "userCommissionInCents": total - float(fee), "currency": "BRL"},
+    }
+    event = {"data": [{
+        "event_name": "Purchase", "event_time": int(time.time()), "event_id": f"cs_{i}",
+        "action_source": "website", "user_data": {"em": "0" * 64},
+        "custom_data": {"currency": "brl", "value": total / 100.0,
+                        "content_ids": ["price_123"], "content_type": "product"},
+    }]}
+    size = 0
+    for _ in range(attempts):
+        size += len(json.dumps(order).encode()) + len(json.dumps(event).encode())
+    return size
+
+
+def after(i: int, attempts: int) -> int:
+    order = Order(
+        order_id=f"cs_{i}", platform="Stripe", payment_method="credit_card", status="paid",
+        created_at=utc(), approved_date=utc(),
+        customer=Customer(name="Fulano", email="f@x.com"),
+        products=[Product.from_line_item(LINE_ITEM)],
+        tracking=tracking_parameters(META), total_in_cents=19700, currency="brl",
+    ).apply_fee(0.0674)
+    event = TrackingEvent(
+        event_name="Purchase", event_id=f"cs_{i}", user_data={"em": "0" * 64},
+        currency="brl", value=197.0, content_ids=["price_123"],
+    )
+    size = 0
+    for _ in range(attempts):
+        size += len(order.to_json()) + len(event.to_json())
+    return size
+
+
+def run(label: str, fn, orders: int, attempts: int):
+    t0 = time.perf_counter()
+    for i in range(orders):
+        fn(i, attempts)
+    elapsed = time.perf_counter() - t0
+
+    tracemalloc.start()
+    fn(0, attempts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:>6}: {elapsed * 1e6 / orders:7.1f} µs/pedido  pico {peak / 1024:6.1f} KiB/pedido")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--attempts", type=int, default=3)
+    args = parser.parse_args()
+    run("before", before, args.orders, args.attempts)
+    run("after", after, args.orders, args.attempts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import asyncio
+import collections
+import os
+import time
+
+import tracing
+from outbox import PermanentDeliveryError
+from resilience import clear_deadline
+
+# Batching do Meta Conversions API. Cada send(evento) entra num lote
+# compartilhado entre requests; o lote sai quando enche (CAPI_BATCH_MAX,
+# o endpoint aceita até 1000) ou quando vence CAPI_FLUSH_INTERVAL.
+CAPI_BATCH_MAX      = int(os.getenv("CAPI_BATCH_MAX", "500"))
+CAPI_FLUSH_INTERVAL = float(os.getenv("CAPI_FLUSH_INTERVAL", "0.5"))
+# o Meta recusa event_time com mais de 7 dias; a margem cobre a espera no outbox
+CAPI_MAX_EVENT_AGE  = float(os.getenv("CAPI_MAX_EVENT_AGE", str(7 * 24 * 3600 - 6 * 3600)))
+
+
+class CapiError(Exception):
+    pass
+
+
+class CapiBatcher:
+    def __init__(self, post, max_batch: int = CAPI_BATCH_MAX,
+                 flush_interval: float = CAPI_FLUSH_INTERVAL):
+        # post: async fn(events: list[bytes]) -> httpx.Response
+        self.post = post
+        self.max_batch = min(max_batch, 1000)
+        self.flush_interval = flush_interval
+        self._pending: dict[str, tuple[bytes, asyncio.Future]] = {}
+        self._timer = None
+        self.batches = 0
+        self.events = 0
+        self.deduped = 0
+        self.splits = 0
+        self._latencies = collections.deque(maxlen=500)
+
+    async def send(self, key: str, event: bytes):
+        # event já serializado; key = "event_name:event_id" (o Meta deduplica
+        # por esse par; aqui também, dentro do lote)
+        queued = self._pending.get(key)
+        if queued is not None:
+            self.deduped += 1
+            return await asyncio.shield(queued[1])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[key] = (event, fut)
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await asyncio.shield(fut)
+
+    def stats(self) -> dict:
+        lat = sorted(self._latencies)
+        return {
+            "batches":    self.batches,
+            "events":     self.events,
+            "deduped":    self.deduped,
+            "splits":     self.splits,
+            "pending":    len(self._pending),
+            "latency_ms": {
+                "p50": round(lat[len(lat) // 2] * 1000, 1) if lat else None,
+                "p95": round(lat[int(len(lat) * 0.95)] * 1000, 1) if lat else None,
+                "max": round(lat[-1] * 1000, 1) if lat else None,
+            },
+        }
+
+    async def flush(self):
+        items = self._take()
+        if items:
+            await self._send_batch(items)
+
+    async def _flush_later(self):
+        # o lote é de vários requests: não herda o deadline de quem o abriu
+        clear_deadline()
+        tracing.detach()
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    def _flush_now(self):
+        items = self._take()
+        asyncio.create_task(self._send_detached(items))
+
+    async def _send_detached(self, items: list):
+        clear_deadline()
+        tracing.detach()
+        await self._send_batch(items)
+
+    def _take(self) -> list:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        items, self._pending = list(self._pending.values()), {}
+        return items
+
+    async def _send_batch(self, items: list):
+        t0 = time.perf_counter()
+        try:
+            resp = await self.post([event for event, _ in items])
+        except Exception as e:
+            self._resolve(items, e)
+            return
+        latency = time.perf_counter() - t0
+        self.batches += 1
+        self._latencies.append(latency)
+        print(f"→ CAPI batch n={len(items)} status={resp.status_code} em {latency * 1000:.0f}ms")
+
+        if resp.status_code < 300:
+            self.events += len(items)
+            self._resolve(items, None)
+        elif resp.status_code == 400 and len(items) > 1:
+            # um evento inválido derruba o lote inteiro: divide e reenvia
+            # as metades até isolar o culpado
+            self.splits += 1
+            mid = len(items) // 2
+            await asyncio.gather(self._send_batch(items[:mid]), self._send_batch(items[mid:]))
+        elif resp.status_code == 400:
+            self._resolve(items, PermanentDeliveryError(f"CAPI rejected event: {resp.text}"))
+        else:
+            # 429/5xx: falha transitória, o outbox reenvia
+            self._resolve(items, CapiError(f"CAPI {resp.status_code}: {resp.text}"))
+
+    @staticmethod
+    def _resolve(items, error):
+        for _, fut in items:
+            if fut.done():
+                continue
+            if error is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(error)
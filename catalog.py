@@ -0,0 +1,57 @@
+import os
+
+from cache import TTLCache
+from stripe_gateway import object_id
+
+# Catálogo de preços/produtos em memória. Aquecido no startup listando os
+# preços ativos, invalidado por price.updated/product.updated no /webhook.
+CATALOG_TTL     = float(os.getenv("CATALOG_TTL", "3600"))
+CATALOG_MAXSIZE = int(os.getenv("CATALOG_MAXSIZE", "1000"))
+
+
+def _entry(price) -> dict:
+    product = price["product"]
+    expanded = product is not None and not isinstance(product, str)
+    return {
+        "id":           price["id"],
+        "unit_amount":  price["unit_amount"],
+        "currency":     price["currency"],
+        "nickname":     price["nickname"],
+        "active":       price["active"],
+        "product_id":   object_id(product),
+        "product_name": product["name"] if expanded else None,
+    }
+
+
+class PriceCatalog:
+    def __init__(self, gateway, ttl: float = CATALOG_TTL, maxsize: int = CATALOG_MAXSIZE):
+        self.gateway = gateway
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, price_id: str) -> dict:
+        entry = self.cache.get(price_id)
+        if entry is None:
+            price = await self.gateway.call("prices.retrieve", price_id, params={"expand": ["product"]})
+            entry = _entry(price)
+            self.cache.set(price_id, entry)
+        return entry
+
+    async def warm(self) -> int:
+        count = 0
+        async for price in self.gateway.paginate(
+            "prices.list", params={"active": True, "limit": 100, "expand": ["data.product"]}
+        ):
+            self.cache.set(price["id"], _entry(price))
+            count += 1
+        return count
+
+    def invalidate_price(self, price_id: str):
+        self.cache.pop(price_id)
+
+    def invalidate_product(self, product_id: str):
+        for entry in self.cache.values():
+            if entry["product_id"] == product_id:
+                self.cache.pop(entry["id"])
+
+    def stats(self) -> dict:
+        return self.cache.stats()
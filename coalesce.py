@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import os
+
+import metrics
+from cache import TTLCache
+
+# Single-flight: requests idênticos em voo (duplo clique, retry do front)
+# esperam o mesmo resultado em vez de repetir Session.retrieve/Price.retrieve
+# e criar outra Session. O resultado fica COALESCE_TTL segundos num cache
+# curto p/ as repetições que chegam logo depois. Erro não é guardado.
+COALESCE_TTL     = float(os.getenv("COALESCE_TTL", "10"))
+COALESCE_MAXSIZE = int(os.getenv("COALESCE_MAXSIZE", "10000"))
+
+
+def request_key(*parts) -> str:
+    # identidade normalizada do request; None/"" contam igual
+    raw = "\x1f".join("" if p is None else str(p).strip() for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name: str, ttl: float = COALESCE_TTL, maxsize: int = COALESCE_MAXSIZE,
+                 cacheable=None):
+        # cacheable: fn(resultado) -> bool; default: tudo que não for None
+        self.name = name
+        self.cacheable = cacheable or (lambda result: result is not None)
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.calls = 0
+        self.joined = 0
+        self.cached = 0
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn):
+        # fn: async fn() -> resultado; roda uma vez por key entre os concorrentes
+        found = self.results.get(key)
+        if found is not None:
+            self.cached += 1
+            metrics.coalesced.inc(self.name, "cached")
+            return found
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            metrics.coalesced.inc(self.name, "leader")
+            # task própria: se quem chegou primeiro desconectar, os outros
+            # continuam esperando o mesmo trabalho
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.joined += 1
+            metrics.coalesced.inc(self.name, "joined")
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None and self.cacheable(task.result()):
+            self.results.set(key, task.result())
+
+    def stats(self) -> dict:
+        total = self.calls + self.joined + self.cached
+        return {
+            "calls":     self.calls,
+            "joined":    self.joined,
+            "cached":    self.cached,
+            "collapsed": round((self.joined + self.cached) / total, 3) if total else None,
+            "inflight":  len(self._inflight),
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import store
+
+# Índice local email -> customer do Stripe, p/ não criar um Customer novo a cada
+# IPN/retry/recompra. Semeado uma vez listando os customers (página a página,
+# memória constante) e mantido pelos webhooks customer.created e
+# checkout.session.completed. As consultas são servidas de um dict em memória;
+# o SQLite só guarda o estado entre restarts.
+CUSTOMER_INDEX_SEED_BATCH = int(os.getenv("CUSTOMER_INDEX_SEED_BATCH", "500"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    email_hash  TEXT PRIMARY KEY,
+    customer_id TEXT NOT NULL,
+    created     REAL NOT NULL
+);
+"""
+
+# com vários customers p/ o mesmo email, o canônico é o mais antigo
+_UPSERT = (
+    "INSERT INTO customers (email_hash, customer_id, created) VALUES (?, ?, ?) "
+    "ON CONFLICT (email_hash) DO UPDATE SET customer_id = excluded.customer_id, "
+    "created = excluded.created WHERE excluded.created < customers.created"
+)
+
+
+def email_hash(email: str) -> str:
+    return hashlib.sha256(email.strip().lower().encode("utf-8")).hexdigest()
+
+
+class CustomerIndex:
+    def __init__(self, gateway, db: str = "customers"):
+        self.gateway = gateway
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.updated = 0
+        self._by_hash = None            # email_hash -> (customer_id, created)
+        self._locks: dict[str, list] = {}   # email_hash -> [lock, usuários]
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = store.connect(self.db)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    @property
+    def entries(self) -> dict:
+        if self._by_hash is None:
+            self._by_hash = {
+                h: (cid, created)
+                for h, cid, created in self.conn.execute("SELECT email_hash, customer_id, created FROM customers")
+            }
+        return self._by_hash
+
+    def get(self, email: str):
+        if not email:
+            return None
+        found = self.entries.get(email_hash(email))
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return found[0]
+
+    def remember(self, email: str, customer_id: str, created: float = None):
+        if not email or not customer_id:
+            return
+        h, created = email_hash(email), created or time.time()
+        if self._remember_hash(h, customer_id, created):
+            self.conn.execute(_UPSERT, (h, customer_id, created))
+
+    def _remember_hash(self, h: str, customer_id: str, created: float) -> bool:
+        current = self.entries.get(h)
+        if current is not None and current[1] <= created:
+            return False
+        self._by_hash[h] = (customer_id, created)
+        return True
+
+    async def seed(self) -> int:
+        # importa todos os customers com email; grava em lotes numa transação
+        count, batch = 0, []
+        async for customer in self.gateway.paginate("customers.list", params={"limit": 100}):
+            if not customer["email"]:
+                continue
+            h = email_hash(customer["email"])
+            if self._remember_hash(h, customer["id"], customer["created"]):
+                batch.append((h, customer["id"], customer["created"]))
+            count += 1
+            if len(batch) >= CUSTOMER_INDEX_SEED_BATCH:
+                self._flush(batch)
+                batch = []
+        self._flush(batch)
+        return count
+
+    def _flush(self, rows: list):
+        if not rows:
+            return
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(_UPSERT, rows)
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    async def upsert(self, email: str, metadata: dict):
+        # customer existente: só atualiza o metadata; senão cria e indexa.
+        # O lock por email evita duas criações em IPNs simultâneos.
+        h = email_hash(email)
+        entry = self._locks.setdefault(h, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                customer_id = self.get(email)
+                if customer_id is not None:
+                    self.updated += 1
+                    return await self.gateway.call("customers.update", customer_id, params={"metadata": metadata})
+                customer = await self.gateway.call("customers.create", params={"email": email, "metadata": metadata})
+                self.created += 1
+                self.remember(email, customer.id, customer.created)
+                return customer
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[h]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size":     len(self.entries),
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "created":  self.created,
+            "updated":  self.updated,
+        }
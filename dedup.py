@@ -0,0 +1,99 @@
+import collections
+import os
+import time
+
+import store
+
+# Dedup de eventos entregues "at least once" (webhooks do Stripe, IPNs do
+# PayPal). LRU em memória na frente de um índice SQLite com TTL; claim() é
+# atômico (INSERT OR IGNORE), então só um processamento passa por chave.
+DEDUP_LRU_SIZE    = int(os.getenv("DEDUP_LRU_SIZE", "50000"))
+DEDUP_TTL         = float(os.getenv("DEDUP_TTL", str(7 * 24 * 3600)))
+DEDUP_PURGE_EVERY = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    namespace TEXT NOT NULL,
+    key       TEXT NOT NULL,
+    seen_at   REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS seen_age ON seen (seen_at);
+"""
+
+
+class DedupStore:
+    def __init__(self, namespace: str, db: str = "dedup",
+                 lru_size: int = DEDUP_LRU_SIZE, ttl: float = DEDUP_TTL):
+        self.namespace = namespace
+        self.db = db
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lru: collections.OrderedDict[str, float] = collections.OrderedDict()
+        self._claims = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = store.connect(self.db)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def claim(self, key: str) -> bool:
+        # True = primeira vez (processe); False = duplicado (pule)
+        now = time.time()
+        seen_at = self._lru.get(key)
+        if seen_at is not None and now - seen_at < self.ttl:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return False
+
+        self._claims += 1
+        if self._claims % DEDUP_PURGE_EVERY == 0:
+            self.purge(now)
+
+        cur = self.conn.execute(
+            "INSERT INTO seen (namespace, key, seen_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET seen_at = excluded.seen_at "
+            "WHERE seen.seen_at < ?",
+            (self.namespace, key, now, now - self.ttl),
+        )
+        if cur.rowcount == 0:
+            # já estava no índice persistente (ex.: antes de um restart)
+            row = self.conn.execute(
+                "SELECT seen_at FROM seen WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            self._remember(key, row[0] if row else now)
+            self.hits += 1
+            return False
+
+        self._remember(key, now)
+        self.misses += 1
+        return True
+
+    def release(self, key: str):
+        # processamento falhou: deixa a próxima entrega tentar de novo
+        self._lru.pop(key, None)
+        self.conn.execute("DELETE FROM seen WHERE namespace = ? AND key = ?", (self.namespace, key))
+
+    def purge(self, now: float = None):
+        cutoff = (now or time.time()) - self.ttl
+        self.conn.execute("DELETE FROM seen WHERE namespace = ? AND seen_at < ?", (self.namespace, cutoff))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits":     self.hits,
+            "misses":   self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "lru_size": len(self._lru),
+        }
+
+    def _remember(self, key: str, seen_at: float):
+        self._lru[key] = seen_at
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
@@ -0,0 +1,32 @@
+import asyncio
+import os
+import time
+
+# Fan-out de side effects independentes: todos rodam juntos, cada um com seu
+# timeout; a falha de um não cancela os outros. O tempo total vira o do ramo
+# mais lento em vez da soma.
+FANOUT_STRIPE_TIMEOUT   = float(os.getenv("FANOUT_STRIPE_TIMEOUT", "8"))
+FANOUT_TRACKING_TIMEOUT = float(os.getenv("FANOUT_TRACKING_TIMEOUT", "10"))
+
+
+async def fan_out(label: str, branches: dict) -> dict:
+    # branches: nome -> (awaitable, timeout); devolve nome -> resultado ou exceção
+    async def run(name, awaitable, timeout):
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except Exception as e:
+            elapsed = (time.perf_counter() - t0) * 1000
+            print(f"→ {label}/{name} falhou em {elapsed:.0f}ms:", repr(e))
+            return e
+
+    names = list(branches)
+    results = await asyncio.gather(*(run(name, *branches[name]) for name in names))
+    return dict(zip(names, results))
+
+
+def raise_first(results: dict):
+    # depois que todos terminaram, propaga o primeiro erro (p/ o Stripe reentregar)
+    for result in results.values():
+        if isinstance(result, Exception):
+            raise result
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
+
+from fastapi.middleware.cors import CORSMiddleware
+
+# Registro de funis: price_id -> URLs de sucesso/cancelamento, template da
+# Session, upsell e taxa. Lido de um JSON (FUNNELS_FILE) e compilado uma vez
+# num índice imutável; o arquivo é relido quando muda e o índice novo troca
+# o antigo numa atribuição só. Arquivo inválido mantém o índice anterior.
+#
+#   {"origins": [...], "defaults": {"success_url", "cancel_url", "fee_rate", "session"},
+#    "funnels": {"nome": {"prices": [...], "success_url", "cancel_url", "upsell", "fee_rate", "session"}}}
+FUNNELS_FILE         = os.getenv("FUNNELS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "funnels.json"))
+FUNNELS_RELOAD_EVERY = float(os.getenv("FUNNELS_RELOAD_EVERY", "5"))      # s; 0 = não relê
+# defaults de quando não havia arquivo; o arquivo tem precedência
+GATEWAY_FEE_RATE     = float(os.getenv("GATEWAY_FEE_RATE", "0.0674"))
+UPSELL_PRICE_MAP     = json.loads(os.getenv("UPSELL_PRICE_MAP", "{}"))    # {"price_do_produto": "price_do_upsell"}
+
+# parâmetros de toda Session; "session" do funil completa/sobrescreve
+SESSION_TEMPLATE = {
+    "payment_method_types": ["card"],
+    "mode": "payment",
+    "customer_creation": "always",
+    "phone_number_collection": {"enabled": True},
+    "payment_intent_data": {"setup_future_usage": "off_session"},
+}
+
+
+def add_sid(url: str) -> str:
+    sep = '&' if '?' in url else '?'
+    return f"{url}{sep}sid={{CHECKOUT_SESSION_ID}}"
+
+
+@dataclass(slots=True, frozen=True)
+class Funnel:
+    name: str
+    success_url: str            # já com o sid={CHECKOUT_SESSION_ID}
+    cancel_url: str
+    upsell: str
+    fee_rate: float
+    session: dict               # template pronto; faltam só itens, email e UTMs
+
+    def session_params(self, price_id: str, quantity, customer_email, metadata: dict) -> dict:
+        return {
+            **self.session,
+            "line_items": [{"price": price_id, "quantity": quantity}],
+            "customer_email": customer_email,
+            # UTMs na Session e no PaymentIntent
+            "metadata": metadata,
+            "payment_intent_data": {**self.session["payment_intent_data"], "metadata": metadata},
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class FunnelIndex:
+    default: Funnel
+    by_price: dict              # price_id -> Funnel
+    fees: dict                  # price_id (produto ou upsell) -> taxa
+    origins: frozenset
+    loaded_at: float
+
+
+def _funnel(name: str, spec: dict, defaults: dict) -> Funnel:
+    spec = {**defaults, **spec}
+    session = {**SESSION_TEMPLATE, **spec.get("session", {})}
+    session["payment_intent_data"] = {**SESSION_TEMPLATE["payment_intent_data"], **session.get("payment_intent_data", {})}
+    if not spec["success_url"] and name != "default":
+        raise ValueError(f"funil {name} sem success_url")
+    session["success_url"] = add_sid(spec["success_url"]) if spec["success_url"] else ""
+    session["cancel_url"] = spec["cancel_url"]
+    return Funnel(
+        name=name,
+        success_url=session["success_url"],
+        cancel_url=spec["cancel_url"],
+        upsell=spec.get("upsell"),
+        fee_rate=float(spec["fee_rate"]),
+        session=session,
+    )
+
+
+def compile_config(config: dict) -> FunnelIndex:
+    defaults = {"fee_rate": GATEWAY_FEE_RATE, "success_url": "", "cancel_url": "", **config.get("defaults", {})}
+    default = _funnel("default", {}, defaults)
+    by_price, fees = {}, {}
+    for name, spec in config.get("funnels", {}).items():
+        funnel = _funnel(name, spec, defaults)
+        for price_id in spec.get("prices", ()):
+            if price_id in by_price:
+                raise ValueError(f"price {price_id} em dois funis: {by_price[price_id].name}, {name}")
+            by_price[price_id] = funnel
+            fees[price_id] = funnel.fee_rate
+        if funnel.upsell:
+            fees.setdefault(funnel.upsell, funnel.fee_rate)
+    # upsells legados do env p/ preços sem upsell no arquivo
+    for price_id, upsell in UPSELL_PRICE_MAP.items():
+        funnel = by_price.get(price_id, default)
+        if funnel.upsell is None:
+            by_price[price_id] = Funnel(funnel.name, funnel.success_url, funnel.cancel_url,
+                                        upsell, funnel.fee_rate, funnel.session)
+            fees.setdefault(upsell, funnel.fee_rate)
+    return FunnelIndex(
+        default=default,
+        by_price=by_price,
+        fees=fees,
+        origins=frozenset(o.rstrip("/") for o in config.get("origins", ())),
+        loaded_at=time.time(),
+    )
+
+
+class FunnelRegistry:
+    def __init__(self, path: str = FUNNELS_FILE, reload_every: float = FUNNELS_RELOAD_EVERY):
+        self.path = path
+        self.reload_every = reload_every
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+        self._mtime = None
+        self._task = None
+        self.index = compile_config({})
+        self.reload()
+
+    def reload(self) -> bool:
+        # relê só se o arquivo mudou; erro mantém o índice em uso
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self._mtime != 0:        # avisa uma vez só
+                print("→ Funis: arquivo não encontrado:", self.path)
+                self._mtime = 0
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                index = compile_config(json.load(f))
+        except Exception as e:
+            self._mtime = mtime
+            self.errors += 1
+            self.last_error = str(e)
+            print("→ Funis: config inválida, mantendo a anterior:", e)
+            return False
+        self._mtime = mtime
+        self.index = index
+        self.reloads += 1
+        print(f"→ Funis carregados: {len(index.by_price)} preços, {len(index.origins)} origens")
+        return True
+
+    def for_price(self, price_id: str) -> Funnel:
+        index = self.index
+        return index.by_price.get(price_id, index.default)
+
+    def upsell_for(self, price_id: str):
+        return self.for_price(price_id).upsell
+
+    def fee_rate(self, price_id: str) -> float:
+        index = self.index
+        return index.fees.get(price_id, index.default.fee_rate)
+
+    def allows_origin(self, origin: str) -> bool:
+        return origin in self.index.origins
+
+    def prices(self) -> list:
+        # produtos e upsells, p/ aquecer o catálogo
+        index = self.index
+        return list(index.by_price.keys() | index.fees.keys())
+
+    def start(self):
+        if self.reload_every > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reload_every)
+            self.reload()
+
+    def stats(self) -> dict:
+        index = self.index
+        funnels = {f.name for f in index.by_price.values()}
+        return {
+            "path":       self.path,
+            "funnels":    len(funnels),
+            "prices":     len(index.by_price),
+            "origins":    sorted(index.origins),
+            "loaded_at":  index.loaded_at,
+            "reloads":    self.reloads,
+            "errors":     self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class FunnelCORSMiddleware(CORSMiddleware):
+    # CORS com as origens do registro (e das lojas, se houver): funil novo
+    # não precisa de deploy
+    def __init__(self, app, registry: FunnelRegistry, tenants=None, **kwargs):
+        super().__init__(app, **kwargs)
+        self.registry = registry
+        self.tenants = tenants
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.registry.allows_origin(origin):
+            return True
+        return self.tenants is not None and self.tenants.allows_origin(origin)
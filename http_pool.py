@@ -0,0 +1,64 @@
+import os
+import urllib.parse
+
+import httpx
+
+# Pool de clientes HTTP assíncronos, um por host (Graph API, UTMify, PayPal…).
+# Cada host tem seu próprio limite de conexões e mantém keep-alive, então só a
+# primeira chamada paga o handshake TCP+TLS.
+HTTP_TIMEOUT                  = float(os.getenv("HTTP_TIMEOUT", "10"))
+HTTP_CONNECT_TIMEOUT          = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_KEEPALIVE_EXPIRY         = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2                         = os.getenv("HTTP2", "1") == "1"
+
+
+class HttpPool:
+    def __init__(self,
+                 timeout: float = HTTP_TIMEOUT,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 max_connections_per_host: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+                 keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+                 http2: bool = HTTP2):
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_connections_per_host,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        parts = urllib.parse.urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        client = self._clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                # h2 só faz sentido com TLS
+                http2=self.http2 and parts.scheme == "https",
+            )
+            self._clients[origin] = client
+        return client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self.client_for(url).request(method, url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def warm(self, url: str):
+        # abre (ou mantém viva) a conexão com o host fora do caminho do
+        # request; o status da resposta não importa
+        parts = urllib.parse.urlsplit(url)
+        await self.client_for(url).head(f"{parts.scheme}://{parts.netloc}/")
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
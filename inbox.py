@@ -0,0 +1,210 @@
+import asyncio
+import collections
+import os
+import random
+import time
+import zlib
+
+import store
+
+# Inbox durável p/ ingestão rápida: o endpoint grava o corpo cru e responde;
+# um pool de workers processa em background. Cada chave de ordenação (ex.: o
+# customer) cai sempre na mesma lane, então eventos do mesmo cliente saem na
+# ordem em que chegaram; se um falha, os seguintes da mesma chave esperam
+# estacionados até ele dar certo ou morrer. Cada tipo pode ter seu limite de
+# concorrência.
+INBOX_MAX_ATTEMPTS = int(os.getenv("INBOX_MAX_ATTEMPTS", "8"))
+INBOX_BASE_DELAY   = float(os.getenv("INBOX_BASE_DELAY", "2"))
+INBOX_MAX_DELAY    = float(os.getenv("INBOX_MAX_DELAY", "300"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbox (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    source      TEXT    NOT NULL,
+    type        TEXT    NOT NULL,
+    order_key   TEXT    NOT NULL,
+    payload     BLOB    NOT NULL,
+    received_at REAL    NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT,
+    state       TEXT    NOT NULL DEFAULT 'pending'
+);
+CREATE INDEX IF NOT EXISTS inbox_pending ON inbox (source, state, id);
+"""
+
+
+def parse_limits(spec: str) -> dict:
+    # "checkout.session.completed=8,payment_intent.succeeded=4"
+    limits = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = int(value)
+    return limits
+
+
+class Inbox:
+    def __init__(self, source: str, handler, db: str = "inbox",
+                 workers: int = 8, limits: dict = None,
+                 max_attempts: int = INBOX_MAX_ATTEMPTS):
+        # handler: async fn(type: str, payload: bytes); exceção = retry
+        self.source = source
+        self.handler = handler
+        self.db = db
+        self.workers = max(1, workers)
+        self.limits = limits or {}
+        self.max_attempts = max_attempts
+        self.processed = 0
+        self.failed = 0
+        self._conn = None
+        self._lanes: list[asyncio.Queue] = []
+        self._sems: dict[str, asyncio.Semaphore] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._timers: set = set()
+        # chave com job em retry -> jobs seguintes estacionados, e quem segura a chave
+        self._parked: dict[str, collections.deque] = {}
+        self._holders: dict[str, int] = {}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = store.connect(self.db)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def put(self, type: str, order_key: str, payload: bytes) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO inbox (source, type, order_key, payload, received_at) VALUES (?, ?, ?, ?, ?)",
+            (self.source, type, order_key or "", payload, time.time()),
+        )
+        if self._lanes:
+            self._route(cur.lastrowid, type, order_key or "", payload, 0)
+        return cur.lastrowid
+
+    def stats(self) -> dict:
+        pending, oldest = self.conn.execute(
+            "SELECT COUNT(*), MIN(received_at) FROM inbox WHERE source = ? AND state = 'pending'",
+            (self.source,),
+        ).fetchone()
+        dead, = self.conn.execute(
+            "SELECT COUNT(*) FROM inbox WHERE source = ? AND state = 'dead'", (self.source,)
+        ).fetchone()
+        return {
+            "pending":     pending,
+            "lag_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "dead":        dead,
+            "queued":      sum(q.qsize() for q in self._lanes),
+            "parked":      sum(len(jobs) for jobs in self._parked.values()),
+            "processed":   self.processed,
+            "failed":      self.failed,
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        self._lanes = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._lanes]
+        # o que ficou pendente antes do restart volta pra fila, na ordem
+        for row_id, type, order_key, payload, attempts in self.conn.execute(
+            "SELECT id, type, order_key, payload, attempts FROM inbox "
+            "WHERE source = ? AND state = 'pending' ORDER BY id",
+            (self.source,),
+        ).fetchall():
+            self._route(row_id, type, order_key, payload, attempts)
+
+    async def stop(self):
+        for timer in self._timers:
+            timer.cancel()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks, self._lanes, self._timers = [], [], set()
+        self._parked, self._holders = {}, {}
+
+    def _route(self, row_id, type, order_key, payload, attempts):
+        lane = zlib.crc32(order_key.encode("utf-8")) % len(self._lanes)
+        self._lanes[lane].put_nowait((row_id, type, order_key, payload, attempts))
+
+    def _sem(self, type: str):
+        sem = self._sems.get(type)
+        if sem is None and type in self.limits:
+            sem = self._sems[type] = asyncio.Semaphore(self.limits[type])
+        return sem
+
+    async def _worker(self, lane: asyncio.Queue):
+        while True:
+            job = await lane.get()
+            try:
+                if not self._park(job):
+                    await self._process(*job)
+            finally:
+                lane.task_done()
+
+    def _park(self, job) -> bool:
+        # chave presa por um job em retry: os seguintes esperam a vez dele
+        row_id, order_key = job[0], job[2]
+        parked = self._parked.get(order_key)
+        if parked is None or self._holders[order_key] == row_id:
+            return False
+        parked.append(job)
+        return True
+
+    def _done(self, row_id, order_key):
+        # job terminou (ok ou morto): libera o próximo estacionado da chave
+        if self._holders.get(order_key) != row_id:
+            return
+        parked = self._parked[order_key]
+        if parked:
+            job = parked.popleft()
+            self._holders[order_key] = job[0]
+            if self._lanes:
+                self._route(*job)
+        else:
+            del self._parked[order_key], self._holders[order_key]
+
+    async def _process(self, row_id, type, order_key, payload, attempts):
+        sem = self._sem(type)
+        try:
+            if sem is None:
+                await self.handler(type, payload)
+            else:
+                async with sem:
+                    await self.handler(type, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failed(row_id, type, order_key, payload, attempts + 1, e)
+            return
+        self.conn.execute("DELETE FROM inbox WHERE id = ?", (row_id,))
+        self.processed += 1
+        self._done(row_id, order_key)
+
+    def _failed(self, row_id, type, order_key, payload, attempts, error):
+        self.failed += 1
+        if attempts >= self.max_attempts:
+            print(f"→ Inbox {self.source} {type} #{row_id} desistiu após {attempts} tentativas:", error)
+            self.conn.execute(
+                "UPDATE inbox SET state = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, str(error), row_id),
+            )
+            self._done(row_id, order_key)
+            return
+        self.conn.execute(
+            "UPDATE inbox SET attempts = ?, last_error = ? WHERE id = ?",
+            (attempts, str(error), row_id),
+        )
+        if order_key:
+            self._parked.setdefault(order_key, collections.deque())
+            self._holders[order_key] = row_id
+        delay = min(INBOX_MAX_DELAY, INBOX_BASE_DELAY * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+        print(f"→ Inbox {self.source} {type} #{row_id} falhou (tentativa {attempts}), retry em {delay:.1f}s:", error)
+        timer = asyncio.get_running_loop().call_later(
+            delay, self._retry, row_id, type, order_key, payload, attempts
+        )
+        self._timers.add(timer)
+
+    def _retry(self, row_id, type, order_key, payload, attempts):
+        now = asyncio.get_running_loop().time()
+        self._timers = {t for t in self._timers if t.when() > now}
+        if self._lanes:
+            self._route(row_id, type, order_key, payload, attempts)
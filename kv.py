@@ -0,0 +1,81 @@
+import json
+import time
+
+import store
+from cache import TTLCache
+
+# Mapa chave -> JSON com expiração, persistido no SQLite e com um TTLCache
+# na frente. Sobrevive a restart e é compartilhado entre workers do mesmo host.
+# get() não apaga linha vencida (um sweep pode precisar dela, ver expired());
+# elas saem no purge(), a cada KV_PURGE_EVERY escritas.
+KV_PURGE_EVERY = 1000
+
+
+class KVCache:
+    def __init__(self, table: str, ttl: float, db: str = "cache", maxsize: int = 10000,
+                 purge_every: int = KV_PURGE_EVERY):
+        # purge_every: 0 = quem usa apaga (sweep + pop)
+        self.table = table
+        self.ttl = ttl
+        self.db = db
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.purge_every = purge_every
+        self._writes = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = store.connect(self.db)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        row = self.conn.execute(
+            f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        remaining = row[1] - time.time()
+        if remaining <= 0:
+            return None
+        value = json.loads(row[0])
+        self.memory.set(key, value, ttl=remaining)
+        return value
+
+    def set(self, key: str, value: dict, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._writes += 1
+        if self.purge_every and self._writes % self.purge_every == 0:
+            self.purge()
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl),
+        )
+        self.memory.set(key, value, ttl=ttl)
+
+    def pop(self, key: str):
+        value = self.get(key)
+        self.memory.pop(key)
+        self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        return value
+
+    def expired(self, now: float = None) -> list:
+        # chaves vencidas (p/ sweeps que precisam agir antes de apagar)
+        rows = self.conn.execute(
+            f"SELECT key, value FROM {self.table} WHERE expires_at <= ?", (now or time.time(),)
+        ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def purge(self, now: float = None):
+        self.conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now or time.time(),))
+
+    def stats(self) -> dict:
+        rows, = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return {**self.memory.stats(), "rows": rows}
@@ -1,192 +1,494 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from decimal import Decimal
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi import APIRouter
+from contextlib import asynccontextmanager
 import os
+import asyncio
 import stripe
-import time
 import hashlib
-import requests
+import time
+import calendar
 import urllib.parse
 import hmac, base64
 import json
 import uuid
+import threading
+
+from http_pool import HttpPool
+from stripe_gateway import StripeGateway, to_plain, object_id
+from outbox import Outbox
+from capi import CapiBatcher, CAPI_BATCH_MAX, CAPI_MAX_EVENT_AGE
+from inbox import Inbox, parse_limits
+from dedup import DedupStore
+from catalog import PriceCatalog
+from kv import KVCache
+from customers import CustomerIndex
+from reconcile import Reconciler
+from upsell import UpsellPrefetcher, idempotency_key
+from fanout import fan_out, raise_first, FANOUT_STRIPE_TIMEOUT, FANOUT_TRACKING_TIMEOUT
+from funnels import FunnelRegistry, FunnelCORSMiddleware
+from warmup import Warmup
+from tenants import TenantRegistry, TenantMiddleware
+from coalesce import SingleFlight, request_key
+from admission import Overloaded, set_priority, INTERACTIVE, BACKGROUND
+import tracing
+from tracing import TracingMiddleware
+from profiler import SamplingProfiler, PROFILE_INTERVAL
+from resilience import Dependency, DeadlineMiddleware, DeadlineExceeded, CircuitOpenError
+import metrics
+from metrics import MetricsMiddleware, LoopLagMonitor
+from models import Order, TrackingEvent, Customer, Product, tracking_parameters, utc
+
+# Pool HTTP compartilhado (keep-alive/HTTP2) p/ CAPI, UTMify e PayPal
+http = HttpPool()
+
+# atraso do event loop, exposto em /metrics
+loop_monitor = LoopLagMonitor()
+
+# Lojas atendidas pelo processo; credenciais e recursos de cada uma em tenants.py
+tenants = TenantRegistry()
+
+def start_tenant(tenant):
+    # chamado dentro de tenants.active(tenant): as tasks herdam o tenant
+    if tenant.stripe_secret_key:
+        tenant.stripe_gw.prepare()
+    tenant.outbox.start()
+    if tenant.stripe_secret_key and CUSTOMER_INDEX_SEED and not tenant.customer_index.entries:
+        asyncio.create_task(seed_customer_index())
+    if WEBHOOK_ASYNC:
+        tenant.webhook_inbox.start()
+    tenant.paypal_inbox.start()
+    if tenant.stripe_secret_key:
+        tenant.reconciler.start()
+    if UPSELL_PRECREATE:
+        tenant.upsell_prefetch.start()
+
+async def stop_tenant(tenant):
+    await tenant.reconciler.stop()
+    await tenant.upsell_prefetch.stop()
+    await tenant.webhook_inbox.stop()
+    await tenant.paypal_inbox.stop()
+    await tenant.outbox.stop()
+    await tenant.capi.flush()
+    await tenant.stripe_gw.aclose()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tracing.install_log_ids()
+    tracing.exporter.start()
+    loop_monitor.start()
+    funnels.start()
+    for tenant in tenants:
+        with tenants.active(tenant):
+            start_tenant(tenant)
+    warmup.start()
+    yield
+    await warmup.stop()
+    for tenant in tenants:
+        with tenants.active(tenant):
+            await stop_tenant(tenant)
+    await http.aclose()
+    await funnels.stop()
+    await loop_monitor.stop()
+    await tracing.exporter.stop()
+    tracing.uninstall_log_ids()
+
+app = FastAPI(lifespan=lifespan)
+
+# deadline por request (X-Request-Timeout / REQUEST_DEADLINE), propagado p/ as dependências
+app.add_middleware(DeadlineMiddleware)
+# latência por rota e requests em andamento (por fora do deadline; CORS,
+# tracing e tenant ficam por fora dele)
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open(request: Request, exc: CircuitOpenError):
+    # falha rápido; quem chamou (browser, Stripe) tenta de novo depois
+    return JSONResponse(
+        status_code=503,
+        content={"error": f"{exc.name} unavailable"},
+        headers={"Retry-After": str(max(1, int(exc.retry_after)))},
+    )
 
-def add_sid(url: str) -> str:
-    sep = '&' if '?' in url else '?'
-    return f"{url}{sep}sid={{CHECKOUT_SESSION_ID}}"
+@app.exception_handler(Overloaded)
+async def stripe_overloaded(request: Request, exc: Overloaded):
+    # fila de admissão do Stripe acima do orçamento: recusa limpa
+    return JSONResponse(
+        status_code=503,
+        content={"error": "busy, try again"},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+@app.exception_handler(stripe.RateLimitError)
+async def stripe_rate_limited(request: Request, exc: stripe.RateLimitError):
+    # 429 que sobrou depois dos retries: mesmo tratamento, em vez de 500
+    return JSONResponse(status_code=503, content={"error": "busy, try again"}, headers={"Retry-After": "1"})
 
-app = FastAPI()
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"error": "deadline exceeded"})
+
+# Funis (price -> URLs, template da Session, upsell, taxa) e origens do CORS,
+# vindos do funnels.json e relidos quando o arquivo muda
+funnels = FunnelRegistry()
 
 # CORS
-origins = [
-    "https://learnmoredigitalcourse.com",
-    "https://yt2025hub.com",
-]
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
+    FunnelCORSMiddleware,
+    registry=funnels,
+    tenants=tenants,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# Env vars
-STRIPE_SECRET_KEY   = os.getenv("STRIPE_SECRET_KEY")
-WEBHOOK_SECRET      = os.getenv("STRIPE_WEBHOOK_SECRET")
-PIXEL_ID            = os.getenv("PIXEL_ID")
-ACCESS_TOKEN        = os.getenv("ACCESS_TOKEN")
+# span raiz do request + X-Trace-Id (dentro do tenant, p/ ver o path já sem /t/<tenant>)
+app.add_middleware(TracingMiddleware)
+
+# tenant do request por /t/<tenant>/..., Origin ou Host (fica por fora de tudo)
+app.add_middleware(TenantMiddleware, registry=tenants)
+
+# Env vars (chaves do Stripe, pixel e token da UTMify são por tenant)
 UTMIFY_API_URL      = os.getenv("UTMIFY_API_URL")
-UTMIFY_API_KEY      = os.getenv("UTMIFY_API_KEY")
+
+# Webhook fast-ack: só valida, persiste e responde; workers processam depois
+WEBHOOK_ASYNC       = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS     = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_TYPE_LIMITS = parse_limits(os.getenv("WEBHOOK_TYPE_LIMITS", ""))
+
+# Upsell pré-criado p/ os funis com "upsell" no funnels.json
+UPSELL_PRECREATE    = os.getenv("UPSELL_PRECREATE", "0") == "1"
+
+GRAPH_API_URL       = os.getenv("GRAPH_API_URL", "https://graph.facebook.com")
+PAYPAL_IPN_URL      = os.getenv("PAYPAL_IPN_URL", "https://ipnpb.paypal.com/cgi-bin/webscr")
+
+# Timeout, retry e circuit breaker por destino externo
+dependencies = {
+    "capi":   Dependency("capi",   float(os.getenv("CAPI_TIMEOUT", "10"))),
+    "utmify": Dependency("utmify", float(os.getenv("UTMIFY_TIMEOUT", "8"))),
+    "paypal": Dependency("paypal", float(os.getenv("PAYPAL_TIMEOUT", "10"))),
+}
+
+# Por loja, daqui até os inboxes: cada tenant tem o seu, e o nome de módulo
+# (stripe_gw, catalog…) resolve p/ o do tenant do contexto atual.
+
+# Gateway assíncrono do Stripe (cliente, pool, admissão e breaker próprios;
+# sem stripe.api_key global)
+for tenant in tenants:
+    tenant.stripe_gw = StripeGateway(tenant.stripe_secret_key, name="stripe" + tenant.suffix)
+    dependencies[tenant.stripe_gw.dependency.name] = tenant.stripe_gw.dependency
+stripe_gw = tenants.local("stripe_gw")
+
+# Catálogo de preços em memória (TTL), aquecido no startup
+for tenant in tenants:
+    tenant.catalog = PriceCatalog(tenant.stripe_gw)
+catalog = tenants.local("catalog")
+
+# sid -> customer/payment_method/UTMs, gravado no checkout.session.completed
+# p/ o upsell 1-click não precisar consultar o Stripe
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", str(24 * 3600)))
+for tenant in tenants:
+    tenant.session_cache = KVCache("sessions" + tenant.suffix, ttl=SESSION_CACHE_TTL)
+session_cache = tenants.local("session_cache")
+
+# Snapshot dos line items gravado na criação da Session: o webhook monta
+# CAPI/UTMify direto do evento, sem Session.retrieve
+CHECKOUT_SNAPSHOT_TTL = float(os.getenv("CHECKOUT_SNAPSHOT_TTL", str(3 * 24 * 3600)))
+for tenant in tenants:
+    tenant.checkout_snapshots = KVCache("checkout_snapshots" + tenant.suffix, ttl=CHECKOUT_SNAPSHOT_TTL)
+checkout_snapshots = tenants.local("checkout_snapshots")
+
+# payment_intent -> payment_method, vindo dos payment_intent.succeeded
+for tenant in tenants:
+    tenant.intent_methods = KVCache("intent_methods" + tenant.suffix, ttl=SESSION_CACHE_TTL)
+intent_methods = tenants.local("intent_methods")
+
+# email -> customer, p/ o PayPal atualizar o Customer existente em vez de criar outro.
+# Semeado no primeiro startup (índice vazio) listando os customers do Stripe
+CUSTOMER_INDEX_SEED = os.getenv("CUSTOMER_INDEX_SEED", "1") == "1"
+for tenant in tenants:
+    tenant.customer_index = CustomerIndex(tenant.stripe_gw, db="customers" + tenant.suffix)
+customer_index = tenants.local("customer_index")
+
+# PaymentIntents de upsell criados antecipadamente (UPSELL_PRECREATE=1)
+for tenant in tenants:
+    tenant.upsell_prefetch = UpsellPrefetcher(tenant.stripe_gw, table="upsell_intents" + tenant.suffix)
+upsell_prefetch = tenants.local("upsell_prefetch")
+
+async def seed_customer_index():
+    set_priority(BACKGROUND)
+    try:
+        print("→ Índice de customers semeado:", await customer_index.seed(), "customers")
+    except Exception as e:
+        print("→ Índice de customers: seed falhou:", e)
+
+async def warm_catalog():
+    # preços ativos + os dos funis (inclusive inativos, que o prices.list não traz)
+    set_priority(BACKGROUND)
+    count = await catalog.warm()
+    await asyncio.gather(*(catalog.get(price_id) for price_id in funnels.prices()))
+    print("→ Catálogo aquecido:", count, "preços")
+
+STRIPE_KEEPWARM_IDLE = float(os.getenv("STRIPE_KEEPWARM_IDLE", "300"))
+
+async def keep_stripe_warm():
+    # com tráfego as próprias chamadas mantêm a conexão; o ping (que gasta
+    # cota da API) só sai com o Stripe parado há STRIPE_KEEPWARM_IDLE
+    if stripe_gw.idle_for() < STRIPE_KEEPWARM_IDLE:
+        return
+    set_priority(BACKGROUND)
+    await stripe_gw.call("prices.list", params={"limit": 1})
+
+# ── Entrega de tracking (usada pelo outbox) ─────────────────────────
+async def post_capi(events: list):
+    # eventos já serializados: monta o {"data": [...]} sem re-encodar
+    tenant = tenants.current()
+    return await dependencies["capi"].call(
+      http.post,
+      f"{GRAPH_API_URL}/v14.0/{tenant.pixel_id}/events",
+      op="events",
+      params={"access_token": tenant.access_token},
+      content=b'{"data":[' + b",".join(events) + b"]}",
+      headers={"Content-Type": "application/json"}
+    )
+
+# agrupa eventos de vários requests num POST só (um lote por pixel)
+for tenant in tenants:
+    tenant.capi = CapiBatcher(post_capi)
+capi = tenants.local("capi")
+
+async def send_capi(body: bytes, key: str):
+    await capi.send(key, body)
+
+async def send_utmify(body: bytes, key: str):
+    resp = await dependencies["utmify"].call(
+      http.post,
+      UTMIFY_API_URL,
+      op="orders",
+      headers={
+        "Content-Type": "application/json",
+        "x-api-token":  tenants.current().utmify_api_key
+      },
+      content=body
+    )
+    print(f"→ UTMify {key}:", resp.status_code, resp.text)
+    resp.raise_for_status()
+
+# Outbox durável: checkout só enfileira; webhook/PayPal tentam na hora e,
+# se falhar, o dispatcher reentrega com backoff
+for tenant in tenants:
+    tenant.outbox = Outbox(
+        {"capi": send_capi, "utmify": send_utmify},
+        db="outbox" + tenant.suffix,
+        # deixa o lote de CAPI encher em vez de limitar a 16 por vez
+        limits={"capi": CAPI_BATCH_MAX},
+        breakers={kind: dependencies[kind].breaker for kind in ("capi", "utmify")},
+    )
+outbox = tenants.local("outbox")
+
+# Aquecimento no startup: conexões com os destinos externos e catálogo/funis.
+# Só Stripe e catálogo seguram o /ready; os hosts de tracking aquecem em
+# paralelo, sem bloquear. Conexões ficam vivas com um request barato a cada
+# KEEPWARM_EVERY (o Stripe só quando parado)
+warmup = Warmup()
+for tenant in tenants:
+    if tenant.stripe_secret_key:
+        warmup.step("catalog" + tenant.suffix, tenants.bind(tenant, warm_catalog))
+        warmup.step("stripe" + tenant.suffix, tenants.bind(tenant, keep_stripe_warm), keep=True)
+graph = any(tenant.pixel_id for tenant in tenants) and GRAPH_API_URL
+for name, url in (("capi", graph), ("utmify", UTMIFY_API_URL), ("paypal", PAYPAL_IPN_URL)):
+    if url:
+        warmup.step(name, lambda url=url: http.warm(url), keep=True, required=False)
 
 @app.get("/health")
 async def health():
+    # liveness: o processo responde; p/ tráfego, ver /ready
     return {"status": "up"}
 
+@app.get("/ready")
+async def ready():
+    return JSONResponse(status_code=200 if warmup.ready else 503, content=warmup.stats())
+
+@app.get("/outbox")
+async def outbox_stats():
+    return {**outbox.stats(), "capi": capi.stats()}
+
+metrics.Gauge(
+    "outbox_pending", "Linhas pendentes no outbox por tenant e kind", ("tenant", "kind"),
+    collect=lambda: {(t.name, kind): v["depth"] for t in tenants for kind, v in t.outbox.stats()["by_kind"].items()},
+)
+metrics.Gauge(
+    "circuit_breaker_open", "1 se o breaker da dependência está aberto", ("dependency",),
+    collect=lambda: {(name,): int(dep.breaker.state != "closed") for name, dep in dependencies.items()},
+)
+
+metrics.Gauge(
+    "stripe_admission_queued", "Chamadas esperando na fila de admissão do Stripe", ("tenant", "priority"),
+    collect=lambda: {(t.name, p): n for t in tenants for p, n in t.stripe_gw.admission.stats()["queued"].items()},
+)
+
+@app.get("/breakers")
+async def breakers():
+    return {name: dep.stats() for name, dep in dependencies.items()}
+
+@app.get("/tenants")
+async def tenant_stats():
+    return {"current": tenants.current().name, "tenants": tenants.stats()}
+
+@app.get("/funnels")
+async def funnel_stats():
+    return funnels.stats()
+
+@app.get("/admission")
+async def admission_stats():
+    return stripe_gw.admission.stats()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/traces")
+async def trace_stats():
+    return tracing.exporter.stats()
+
+# Profiler sob demanda: POST /admin/profile?seconds=10 com
+# "Authorization: Bearer $ADMIN_TOKEN" devolve as pilhas no formato collapsed
+# (flamegraph.pl / speedscope). Sem ADMIN_TOKEN o endpoint não existe
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+profiler = SamplingProfiler()
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "Not Found")
+    token = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(401, "Unauthorized")
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, interval: float = PROFILE_INTERVAL,
+                        all_threads: bool = False):
+    require_admin(request)
+    # por padrão só a thread do event loop (onde rodam os handlers)
+    threads = None if all_threads else {threading.get_ident()}
+    try:
+        stacks = await asyncio.to_thread(profiler.sample, max(0.1, seconds), max(0.001, interval), threads)
+    except RuntimeError:
+        raise HTTPException(409, "Profile already running")
+    return PlainTextResponse(profiler.collapsed(stacks), headers={"X-Profile-Samples": str(profiler.last["samples"])})
+
+@app.get("/admin/profile")
+async def admin_profile_stats(request: Request):
+    require_admin(request)
+    return profiler.stats()
+
 @app.post("/ping")
 async def ping():
     return {"pong": True}
 
+# duplo clique / retry do front: requests com o mesmo token de idempotência
+# (header Idempotency-Key ou campo idempotency_key, gerado pela página) em voo
+# viram um só, e a resposta fica alguns segundos p/ as repetições (só as de
+# sucesso). Sem token não há coalescing: IP + user-agent não identificam o
+# comprador atrás do router/NAT
+checkout_flight = SingleFlight("/create-checkout-session", cacheable=lambda r: isinstance(r, dict))
+upsell_flight   = SingleFlight("/upsell/intent", cacheable=lambda r: isinstance(r, dict))
+
+@app.get("/coalesce")
+async def coalesce_stats():
+    return {"checkout": checkout_flight.stats(), "upsell": upsell_flight.stats()}
+
 @app.post("/create-checkout-session")
 async def create_checkout_session(request: Request):
-    stripe.api_key = STRIPE_SECRET_KEY
-
-    body = await request.json()
-    price_id = body.get("price_id")
-    quantity = body.get("quantity", 1)
-    customer_email = body.get("customer_email")
-    # coletamos os UTMs
-    utms = { k: body.get(k, "") for k in (
-        "utm_source", 
-        "utm_medium",
-        "utm_campaign",
-        "utm_term",
-        "utm_content"
-    ) }
+    set_priority(INTERACTIVE)
+    with tracing.span("checkout.parse"):
+        body = await request.json()
+        price_id = body.get("price_id")
+        quantity = body.get("quantity", 1)
+        customer_email = body.get("customer_email")
+        # coletamos os UTMs
+        utms = { k: body.get(k, "") for k in (
+            "utm_source", 
+            "utm_medium",
+            "utm_campaign",
+            "utm_term",
+            "utm_content"
+        ) }
 
     if not price_id:
         return JSONResponse(status_code=400, content={"error": "price_id is required"})
 
-    # escolhe a URL de sucesso de acordo com o produto
-    if price_id in (
-        'price_1RuLSnEHsMKn9uopKXdIKW4T',
-        'price_1RxdG9EHsMKn9uopZQAj9Tjs',
-        'price_1RuLumEHsMKn9uopQYJvI5La'
-    ):
-        success_url = add_sid('https://learnmoredigitalcourse.com/teste-pink-down1-stripe')
-    else:
-        success_url = add_sid('https://yt2025hub.com/presell-stripe/grow2025/vsl')
-
-    session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        line_items=[{'price': price_id, 'quantity': quantity}],
-        mode='payment',
-        customer_creation='always',
-        customer_email=customer_email,
-        phone_number_collection={"enabled": True},
-        success_url=success_url,
-        cancel_url='https://learnmoredigitalcourse.com/erro',
-        # grava UTMs na própria Session
-        metadata=utms,
-        # grava UTMs também no PaymentIntent
-        payment_intent_data={
-            "metadata": utms,
-            "setup_future_usage": "off_session"
-        },
-        expand=["line_items"]
-    )
+    token = request.headers.get("idempotency-key") or body.get("idempotency_key")
+    if not token:
+        return await open_checkout_session(request, price_id, quantity, customer_email, utms)
+    # mesmo token e mesmo pedido = mesma Session
+    key = request_key(tenants.current().name, token, price_id, quantity)
+    return await checkout_flight.do(key, lambda: open_checkout_session(request, price_id, quantity, customer_email, utms))
 
-    # Conversions API: InitiateCheckout
-    event_payload = {
-      "data": [{
-        "event_name":    "InitiateCheckout",
-        "event_time":    int(time.time()),
-        "event_id":      session.id,
-        "action_source": "website",
-        "event_source_url": str(request.url),
-        "user_data": {
-          "client_ip_address": request.client.host,
-          "client_user_agent": request.headers.get("user-agent")
-        },
-        "custom_data": {
-          "currency": session.currency,
-          "value":    session.amount_total / 100.0,
-          "content_ids": [item.price.id for item in session.line_items.data],
-          "content_type": "product"
-        }
-      }]
-    }
-    # envia e loga o response para debug
-    resp = requests.post(
-      f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-      params={"access_token": ACCESS_TOKEN},
-      json=event_payload
-    )
-    print("→ InitiateCheckout event sent:", resp.status_code, resp.text)
-
-    # ──────────────────────────────────────────────────
-    #  Envia pedido (order) ao UTMify
-    cd = session.customer_details or {}
-    customer_name  = getattr(cd, "name", "") or ""
-    customer_email = getattr(cd, "email", "") or ""
-    customer_phone = getattr(cd, "phone", None)
-    
-    utmify_order = {
-      "orderId":       session.id,
-      "platform":      "Stripe",
-      "paymentMethod": "credit_card",
-      "status":        "waiting_payment",
-      "createdAt":     time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-      "approvedDate":  None,
-      "refundedAt":    None,
-      "customer": {
-          "name":     customer_name,
-          "email":    customer_email,
-          "phone":    customer_phone,
-          "document": None
-      },
-      "products": [
-        {
-          "id":            item.price.id,
-          "name":          item.description or item.price.id,
-          "planId":        item.price.id,
-          "planName":      item.price.nickname or "",
-          "quantity":      item.quantity,
-          "priceInCents":  item.amount_subtotal
-        }
-        for item in session.line_items.data
-      ],
-      "trackingParameters": {
-        "utm_source":       session.metadata.get("utm_source",""),
-        "utm_medium":       session.metadata.get("utm_medium",""),
-        "utm_campaign":     session.metadata.get("utm_campaign",""),
-        "utm_term":         session.metadata.get("utm_term",""),
-        "utm_content":      session.metadata.get("utm_content","")
-      },
-      "commission": {
-        "totalPriceInCents":     session.amount_total,
-        "gatewayFeeInCents":     0,
-        "userCommissionInCents": 0,
-        "currency":              session.currency.upper()
-      }
-    }
-    resp_utm = requests.post(
-      UTMIFY_API_URL,
-      headers={
-        "Content-Type": "application/json",
-        "x-api-token":  UTMIFY_API_KEY
-      },
-      json=utmify_order
-    )
-    print("→ Order enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
-    # ──────────────────────────────────────────────────
+async def open_checkout_session(request: Request, price_id, quantity, customer_email, utms: dict):
+    # URLs e parâmetros da Session já vêm prontos do funil do produto
+    funnel = funnels.for_price(price_id)
+    with tracing.span("checkout.session", price_id=price_id, tenant=tenants.current().name) as span:
+        create = stripe_gw.call("checkout.sessions.create",
+                                params=funnel.session_params(price_id, quantity, customer_email, utms))
+        # price/nickname/produto vêm do catálogo, sem expandir line_items;
+        # só alimentam o tracking: se o catálogo falhar a Session já existe
+        # e o checkout segue com o price_id como nome
+        session, price = await asyncio.gather(create, catalog.get(price_id), return_exceptions=True)
+        if isinstance(session, BaseException):
+            raise session
+        span.set("session_id", session.id)
+    if isinstance(price, BaseException):
+        print(f"→ Catálogo indisponível p/ {price_id}:", price)
+        price = {"product_name": None, "nickname": None}
+    session_meta = to_plain(session.metadata)
+    line_items = [{
+        "price_id":        price_id,
+        "name":            price["product_name"] or price_id,
+        "nickname":        price["nickname"],
+        "quantity":        int(quantity),
+        "amount_subtotal": session.amount_subtotal,
+    }]
+    checkout_snapshots.set(session.id, {"line_items": line_items})
+
+    with tracing.span("checkout.enqueue"):
+        # Conversions API: InitiateCheckout
+        event = TrackingEvent(
+            event_name="InitiateCheckout",
+            event_id=session.id,
+            event_source_url=str(request.url),
+            user_data={
+              "client_ip_address": request.client.host,
+              "client_user_agent": request.headers.get("user-agent")
+            },
+            currency=session.currency,
+            value=session.amount_total / 100.0,
+            content_ids=[item["price_id"] for item in line_items],
+        )
+        # enfileira no outbox; o dispatcher envia fora do caminho da resposta
+        outbox.enqueue("capi", event.to_json(), event.key)
+
+        # ──────────────────────────────────────────────────
+        #  Envia pedido (order) ao UTMify (customer_details só existe depois do pagamento)
+        order = Order(
+            order_id=session.id,
+            platform="Stripe",
+            payment_method="credit_card",
+            status="waiting_payment",
+            created_at=utc(),
+            customer=Customer(),
+            products=[Product.from_line_item(item) for item in line_items],
+            tracking=tracking_parameters(session_meta),
+            total_in_cents=session.amount_total,
+            currency=session.currency,
+        )
+        outbox.enqueue("utmify", order.to_json(), order.key)
+        # ──────────────────────────────────────────────────
 
     return {"checkout_url": session.url}
 
 @app.post("/upsell/intent")
 async def create_upsell_intent(request: Request):
-    stripe.api_key = STRIPE_SECRET_KEY
+    set_priority(INTERACTIVE)
     body = await request.json()
     sid      = body.get("sid")
     price_id = body.get("price_id")
@@ -195,36 +497,64 @@ async def create_upsell_intent(request: Request):
     if not sid or not price_id:
         return JSONResponse(status_code=400, content={"error": "sid and price_id are required"})
 
-    # 1) Recupera a Session anterior e extrai customer + payment_method
-    sess = stripe.checkout.Session.retrieve(
-        sid,
-        expand=["payment_intent.payment_method", "customer"]
-    )
-    if not sess or not sess.customer:
-        return JSONResponse(status_code=400, content={"error": "Invalid session or missing customer"})
+    # duplicados esperam o mesmo intent em vez de refazer os retrieves
+    key = request_key(tenants.current().name, sid, price_id, quantity)
+    return await upsell_flight.do(key, lambda: upsell_intent(sid, price_id, quantity))
+
+async def upsell_intent(sid, price_id, quantity: int):
+    with tracing.span("upsell.lookup", sid=sid) as span:
+        # 0) Intent já pré-criado pelo webhook? devolve direto
+        ready = upsell_prefetch.take(sid, price_id, quantity) if UPSELL_PRECREATE else None
+        if ready:
+            span.set("precreated", True)
+            return {"client_secret": ready["client_secret"], "intent_id": ready["intent_id"]}
 
-    customer_id = sess.customer
+        # 1) customer + payment_method: primeiro o cache gravado pelo webhook
+        cached = session_cache.get(sid) or {}
+        cached_pm = cached.get("payment_method") or intent_methods.get(cached.get("payment_intent") or "")
+        if cached.get("customer") and cached_pm:
+            customer_id = cached["customer"]
+            pm_id       = cached_pm
+            sess_meta   = dict(cached["metadata"])
+        else:
+            # miss: recupera a Session anterior e extrai customer + payment_method
+            sess = await stripe_gw.call(
+                "checkout.sessions.retrieve",
+                sid,
+                params={"expand": ["payment_intent.payment_method", "customer"]}
+            )
+            if not sess or not sess.customer:
+                return JSONResponse(status_code=400, content={"error": "Invalid session or missing customer"})
+
+            customer_id = object_id(sess.customer)
 
-    # preferimos o PM da PI da Session
-    pm = getattr(getattr(sess, "payment_intent", None), "payment_method", None)
-    pm_id = pm.id if pm else None
+            # preferimos o PM da PI da Session
+            pm = getattr(getattr(sess, "payment_intent", None), "payment_method", None)
+            pm_id = pm.id if pm else None
 
-    # fallback: default do customer
-    if not pm_id and getattr(sess, "customer", None):
-        cust = sess.customer if isinstance(sess.customer, dict) else stripe.Customer.retrieve(customer_id)
-        pm_id = (cust.get("invoice_settings", {}) or {}).get("default_payment_method")
+            # fallback: default do customer
+            if not pm_id and getattr(sess, "customer", None):
+                cust = sess.customer if not isinstance(sess.customer, str) else await stripe_gw.call("customers.retrieve", customer_id)
+                pm_id = object_id((to_plain(cust).get("invoice_settings") or {}).get("default_payment_method"))
 
-    if not pm_id:
-        # Sem método salvo? devolve erro orientando a abrir um novo Checkout
-        return JSONResponse(status_code=409, content={"error": "No saved payment method; redirect to checkout"})
+            if not pm_id:
+                # Sem método salvo? devolve erro orientando a abrir um novo Checkout
+                return JSONResponse(status_code=409, content={"error": "No saved payment method; redirect to checkout"})
+            sess_meta = to_plain(sess.metadata)
+            session_cache.set(sid, {"customer": customer_id, "payment_method": pm_id, "metadata": sess_meta})
+
+    with tracing.span("upsell.intent", price_id=price_id):
+        intent = await create_upsell_payment_intent(sid, customer_id, pm_id, sess_meta, price_id, quantity)
+    return {"client_secret": intent.client_secret, "intent_id": intent.id}
 
+async def create_upsell_payment_intent(sid, customer_id, pm_id, sess_meta, price_id, quantity):
     # 2) Carrega o price para pegar valor/moeda/identificação
-    price = stripe.Price.retrieve(price_id)
+    price = await catalog.get(price_id)
     amount_minor = price["unit_amount"] * quantity
     currency = price["currency"]
 
     # 3) Metadados: copie UTMs da Session anterior e marque como upsell
-    base_meta = dict(sess.metadata or {})
+    base_meta = dict(sess_meta)
     base_meta.update({
         "upsell": "true",
         "parent_session": sid,
@@ -233,368 +563,556 @@ async def create_upsell_intent(request: Request):
     })
 
     # 4) Idempotência p/ evitar dupla cobrança por duplo clique
-    idem_key = f"upsell:{sid}:{price_id}:{quantity}"
-
-    intent = stripe.PaymentIntent.create(
-        amount=amount_minor,
-        currency=currency,
-        customer=customer_id,
-        payment_method=pm_id,
-        confirmation_method="automatic",   # confirmaremos no front
-        metadata=base_meta,
-        idempotency_key=idem_key
-    )
+    idem_key = idempotency_key(sid, price_id, quantity)
+    params = {
+        "amount": amount_minor,
+        "currency": currency,
+        "customer": customer_id,
+        "payment_method": pm_id,
+        "confirmation_method": "automatic",   # confirmaremos no front
+        "metadata": base_meta,
+    }
 
-    return {"client_secret": intent.client_secret, "intent_id": intent.id}
+    intent = await stripe_gw.call("payment_intents.create", params=params, options={"idempotency_key": idem_key})
+    if intent.status == "canceled":
+        # o pré-criado expirou e foi cancelado pelo sweep; gera outro
+        intent = await stripe_gw.call("payment_intents.create", params=params, options={"idempotency_key": idem_key + ":renew"})
+    return intent
 
-@app.post("/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
-    sig     = request.headers.get("stripe-signature", "")
+async def precreate_upsell(sid, line_items, customer_id, pm_id, meta):
+    # cria o PaymentIntent do upsell do funil antes do clique do comprador
+    main_price = line_items[0]["price_id"] if line_items else None
+    upsell_price = funnels.upsell_for(main_price)
+    if not upsell_price or not customer_id or not pm_id:
+        return
+    try:
+        intent = await create_upsell_payment_intent(sid, customer_id, pm_id, meta, upsell_price, 1)
+        upsell_prefetch.store(sid, upsell_price, 1, intent)
+    except Exception as e:
+        print("→ Upsell pré-criado erro:", e)
 
-    # 1) Garante que podemos chamar a API do Stripe
-    stripe.api_key = STRIPE_SECRET_KEY
+# ── Payloads de tracking dos pagamentos (webhook e reconciliação) ───
+# paid_at: epoch do pagamento; None = agora (webhook). A reconciliação passa o
+# timestamp do objeto original p/ event_time e approvedDate
+def session_paid(session: dict, line_items: list, paid_at: float = None):
+    paid_at = time.time() if paid_at is None else paid_at
+    details = session.get("customer_details") or {}
+    # 3.1) Purchase para o Meta
+    email_hash = hashlib.sha256(
+        (details.get("email") or "").encode("utf-8")
+    ).hexdigest()
+    purchase = TrackingEvent(
+        event_name="Purchase",
+        event_id=session["id"],
+        event_source_url=session.get("url"),
+        user_data={"em": email_hash},
+        currency=session["currency"],
+        value=session["amount_total"] / 100.0,
+        content_ids=[li["price_id"] for li in line_items],
+        event_time=int(paid_at),
+    )
 
-    # 2) Valida a assinatura do webhook
-    try:
-        event = stripe.Webhook.construct_event(payload, sig, WEBHOOK_SECRET)
-    except stripe.error.SignatureVerificationError as e:
-        print("⚠️ Webhook signature mismatch:", e)
-        raise HTTPException(400, "Invalid webhook signature")
+    # 3.2) Atualiza todo o order como "paid" — POST full payload
+    order = Order(
+        order_id=session["id"],
+        platform="Stripe",
+        payment_method="credit_card",
+        status="paid",
+        # createdAt original a partir do timestamp da session
+        created_at=utc(session["created"]),
+        approved_date=utc(paid_at),
+        customer=Customer(
+            name=details.get("name") or "",
+            email=details.get("email"),
+            phone=details.get("phone") or None,
+        ),
+        products=[Product.from_line_item(li) for li in line_items],
+        tracking=tracking_parameters(session.get("metadata") or {}),
+        total_in_cents=session["amount_total"],
+        currency=session["currency"],
+    ).apply_fee(funnels.fee_rate(line_items[0]["price_id"] if line_items else None))
+    return purchase, order
+
+def upsell_paid(intent: dict, email, name, phone, product_name, paid_at: float = None):
+    paid_at = time.time() if paid_at is None else paid_at
+    meta = intent.get("metadata") or {}
+    upsell_price_id = meta.get("price_id")
+    # ── CAPI Purchase (email hash se disponível) ────────────────────
+    total = int(intent["amount"])                      # em centavos
+    email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest() if email else None
+    purchase = TrackingEvent(
+        event_name="Purchase",
+        event_id=intent["id"],
+        user_data=({"em": email_hash} if email_hash else {}),
+        currency=intent["currency"],
+        value=total / 100.0,
+        content_ids=[upsell_price_id] if upsell_price_id else [],
+        event_time=int(paid_at),
+    )
+
+    # ── UTMify paid (mantendo campos e comissão como no principal) ──
+    order = Order(
+        order_id=intent["id"],
+        platform="Stripe",
+        payment_method="credit_card",
+        status="paid",
+        created_at=utc(intent["created"]),
+        approved_date=utc(paid_at),
+        customer=Customer(name=name or "", email=email or "", phone=phone or None),
+        products=[Product(
+            id=upsell_price_id,
+            name=product_name or upsell_price_id or "Upsell",
+            plan_id=upsell_price_id,
+            plan_name="Upsell",
+            quantity=int(meta.get("quantity","1") or "1"),
+            price_in_cents=total,
+        )],
+        tracking=tracking_parameters(meta),
+        total_in_cents=total,
+        currency=intent["currency"],
+    ).apply_fee(funnels.fee_rate(upsell_price_id))
+    return purchase, order
 
-    # 3) Se for checkout.session.completed, processa
+async def process_stripe_event(event: dict):
+    # Se for checkout.session.completed, processa
     if event["type"] == "checkout.session.completed":
-        session = stripe.checkout.Session.retrieve(
-            event["data"]["object"]["id"],
-            expand=["line_items"]
-        )
-        # captura o createdAt original a partir do timestamp da session:
-        original_created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(session.created))
-        cust = session["customer"]
-
-        # 3.1) Primeiro, guarda as UTMs no Customer
-        stripe.Customer.modify(
-            cust, 
-            metadata=session.metadata,
-            name=session.customer_details.name,
-            phone=session.customer_details.phone
-        )
+        # a Session já vem no evento; line items saem do snapshot local
+        session = event["data"]["object"]
+        snapshot = checkout_snapshots.get(session["id"])
+        if snapshot is not None:
+            line_items = snapshot["line_items"]
+        else:
+            line_items = await fetch_line_items(session["id"])
 
-        # 3.2) Prepara o payload de Purchase para o Meta
-        email_hash = hashlib.sha256(
-            session.customer_details.email.encode("utf-8")
-        ).hexdigest()
-        purchase_payload = {
-            "data": [{
-                "event_name":    "Purchase",
-                "event_time":    int(time.time()),
-                "event_id":      session.id,
-                "action_source": "website",
-                "event_source_url": session.url,
-                "user_data":     {"em": email_hash},
-                "custom_data":   {
-                    "currency":     session.currency,
-                    "value":        session.amount_total / 100.0,
-                    "content_ids":  [li.price.id for li in session.line_items.data],
-                    "content_type": "product"
-                }
-            }]
-        }
-        
-        resp = requests.post(
-            f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-            params={"access_token": ACCESS_TOKEN},
-            json=purchase_payload
-        )
-        print("→ Purchase event sent:", resp.status_code, resp.text)
-
-        # 4.1) Atualiza todo o order como "paid" — POST full payload
-        total = session.amount_total
-        fee   = total * Decimal("0.0674")        
-        net   = total - fee      
-        
-        utmify_order_paid = {
-          "orderId":       session.id,
-          "platform":      "Stripe",
-          "paymentMethod": "credit_card",
-          "status":        "paid",
-          "createdAt":     original_created_at,   # timestamp que você calculou lá em cima
-          "approvedDate":  time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-          "refundedAt":    None,
-          "customer": {
-            "name":     session.customer_details.name  or "",
-            "email":    session.customer_details.email,
-            "phone":    session.customer_details.phone or None,
-            "document": None
-          },
-          "products": [
-            {
-              "id":            li.price.id,
-              "name":          li.description or li.price.id,
-              "planId":        li.price.id,
-              "planName":      li.price.nickname or None,
-              "quantity":      li.quantity,
-              "priceInCents":  li.amount_subtotal
-            }
-            for li in session.line_items.data
-          ],
-          "trackingParameters": {
-            "utm_source":     session.metadata.get("utm_source",""),
-            "utm_medium":     session.metadata.get("utm_medium",""),
-            "utm_campaign":   session.metadata.get("utm_campaign",""),
-            "utm_term":       session.metadata.get("utm_term",""),
-            "utm_content":    session.metadata.get("utm_content","")
-          },
-         "commission": {
-            "totalPriceInCents":     float(total),  
-            "gatewayFeeInCents":     float(fee),
-            "userCommissionInCents": float(net),
-            "currency":              session.currency.upper()
-         }
+        session_meta = session.get("metadata") or {}
+        details = session.get("customer_details") or {}
+        cust = object_id(session.get("customer"))
+
+        # guarda o que o upsell 1-click precisa (evita Session.retrieve lá)
+        pi_id = object_id(session.get("payment_intent"))
+        pm_id = intent_methods.get(pi_id) if pi_id else None
+        if UPSELL_PRECREATE and pi_id and not pm_id:
+            # o payment_intent.succeeded ainda não chegou; o pré-criado precisa do PM
+            pm_id = object_id((await stripe_gw.call("payment_intents.retrieve", pi_id)).payment_method)
+        session_cache.set(session["id"], {
+            "customer":         cust,
+            "payment_intent":   pi_id,
+            "payment_method":   pm_id,
+            "metadata":         session_meta,
+            "customer_details": {k: details.get(k) for k in ("name", "email", "phone")},
+        })
+        customer_index.remember(details.get("email"), cust, session["created"])
+
+        # 3) Purchase p/ o Meta e pedido "paid" p/ a UTMify
+        purchase, order = session_paid(session, line_items)
+
+        # 4) Purchase no Meta: só enfileira; o dispatcher entrega no lote do
+        #    CAPI sem o evento esperar o timer do lote
+        outbox.enqueue("capi", purchase.to_json(), purchase.key)
+
+        # 5) UTMs no Customer, "paid" na UTMify (e o upsell pré-criado) são
+        #    independentes: rodam juntos, cada um com timeout
+        branches = {
+            "customers.update": (stripe_gw.call("customers.update", cust, params={
+                "metadata": session_meta,
+                "name": details.get("name"),
+                "phone": details.get("phone")
+            }), FANOUT_STRIPE_TIMEOUT),
+            "utmify": (outbox.deliver("utmify", order.to_json(), order.key), FANOUT_TRACKING_TIMEOUT),
         }
-        
-        resp_utm = requests.post(
-          UTMIFY_API_URL,
-          headers={
-            "Content-Type": "application/json",
-            "x-api-token":  UTMIFY_API_KEY
-          },
-          json=utmify_order_paid
-        )
-        print("→ Pedido atualizado como pago na UTMify:", resp_utm.status_code, resp_utm.text)
-        
+        if UPSELL_PRECREATE:
+            branches["upsell"] = (precreate_upsell(session["id"], line_items, cust, pm_id, session_meta), FANOUT_STRIPE_TIMEOUT)
+        raise_first(await fan_out("checkout.session.completed", branches))
+
+    elif event["type"] == "customer.created":
+        customer = event["data"]["object"]
+        customer_index.remember(customer.get("email"), customer["id"], customer["created"])
+
+    elif event["type"] in ("price.updated", "price.deleted"):
+        catalog.invalidate_price(event["data"]["object"]["id"])
+
+    elif event["type"] in ("product.updated", "product.deleted"):
+        catalog.invalidate_product(event["data"]["object"]["id"])
+
     elif event["type"] == "payment_intent.succeeded":
         # ↳ UPSSELL 1-CLICK (confirmado no front com confirmCardPayment)
-        intent_id = event["data"]["object"]["id"]
-        intent = stripe.PaymentIntent.retrieve(intent_id, expand=["latest_charge"])
+        intent = event["data"]["object"]
+
+        # todo PI pago registra o PM (o upsell 1-click do checkout usa)
+        if intent.get("payment_method"):
+            intent_methods.set(intent["id"], object_id(intent["payment_method"]))
 
         # Só processa se marcamos como upsell no metadata
-        meta = dict(getattr(intent, "metadata", {}) or {})
+        meta = intent.get("metadata") or {}
         if meta.get("upsell") != "true":
             # não é upsell, ignorar
-            return JSONResponse({"received": True})
+            return
 
         # ── Dados do cliente (name/email/phone) ──────────────────────────
-        email = name = phone = None
-
-        # 1) billing_details da primeira charge
-        ch = getattr(intent, "charges", None)
-        if ch and getattr(ch, "data", None):
-            c0 = ch.data[0]
-            bd = getattr(c0, "billing_details", None)
-            if bd:
-                email = getattr(bd, "email", None) or None
-                name  = getattr(bd, "name",  None) or None
-                phone = getattr(bd, "phone", None) or None
-
-        if (not email or not name or not phone) and getattr(intent, "latest_charge", None):
-            bd = getattr(intent.latest_charge, "billing_details", None)
-            if bd:
-                email = getattr(bd, "email", None) or email
-                name  = getattr(bd, "name",  None) or name
-                phone = getattr(bd, "phone", None) or phone
-
-        # 2) fallback: Customer
-        cust_id = getattr(intent, "customer", None)
+        # 1) o que o checkout.session.completed da Session original guardou
+        parent = session_cache.get(meta.get("parent_session") or "") or {}
+        contact = parent.get("customer_details") or {}
+        email = contact.get("email") or None
+        name  = contact.get("name")  or None
+        phone = contact.get("phone") or None
+
+        # fallback: billing_details da charge (único re-fetch do PI)
+        if not email or not name or not phone:
+            email, name, phone = await charge_contact(intent["id"], email, name, phone)
+
+        # 2) fallback: Customer — em paralelo com o produto do catálogo
+        cust_id = object_id(intent.get("customer"))
+        upsell_price_id = meta.get("price_id")
+        lookups = {}
         if cust_id and (not email or not name or not phone):
-            cust = stripe.Customer.retrieve(cust_id)
+            lookups["customers.retrieve"] = (stripe_gw.call("customers.retrieve", cust_id), FANOUT_STRIPE_TIMEOUT)
+        if upsell_price_id:
+            lookups["catalog"] = (catalog.get(upsell_price_id), FANOUT_STRIPE_TIMEOUT)
+        found = await fan_out("payment_intent.succeeded", lookups)
+
+        cust = found.get("customers.retrieve")
+        if cust is not None and not isinstance(cust, Exception):
+            cust = to_plain(cust)
             email = email or (cust.get("email") or None)
             name  = name  or (cust.get("name")  or None)
             phone = phone or (cust.get("phone") or None)
 
-        # ── Cálculos (mesma regra do seu código) ────────────────────────
-        total = int(intent.amount)                         # em centavos
-        fee   = total * Decimal("0.0674")
-        net   = total - fee
-
-        # ── CAPI Purchase (email hash se disponível) ────────────────────
-        email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest() if email else None
-        purchase_payload = {
-            "data": [{
-                "event_name": "Purchase",
-                "event_time": int(time.time()),
-                "event_id":   intent.id,
-                "action_source": "website",
-                "user_data": ({"em": email_hash} if email_hash else {}),
-                "custom_data": {
-                    "currency": intent.currency,
-                    "value":    total / 100.0,
-                    "content_ids":  [meta.get("price_id")] if meta.get("price_id") else [],
-                    "content_type": "product"
-                }
-            }]
-        }
-        try:
-            requests.post(
-                f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-                params={"access_token": ACCESS_TOKEN},
-                json=purchase_payload
-            )
-        except Exception as e:
-            print("→ CAPI (upsell) erro:", e)
-
-        # ── UTMify paid (mantendo campos e comissão como no principal) ──
-        utmify_order_paid = {
-          "orderId":       intent.id,
-          "platform":      "Stripe",
-          "paymentMethod": "credit_card",
-          "status":        "paid",
-          "createdAt":     time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(intent.created)),
-          "approvedDate":  time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-          "refundedAt":    None,
-          "customer": {
-            "name":     name  or "",
-            "email":    email or "",
-            "phone":    phone or None,
-            "document": None
-          },
-          "products": [
-            {
-              "id":           meta.get("price_id"),
-              "name":         meta.get("price_id") or "Upsell",
-              "planId":       meta.get("price_id"),
-              "planName":     "Upsell",
-              "quantity":     int(meta.get("quantity","1") or "1"),
-              "priceInCents": total
-            }
-          ],
-          "trackingParameters": {
-            "utm_source":   meta.get("utm_source",""),
-            "utm_medium":   meta.get("utm_medium",""),
-            "utm_campaign": meta.get("utm_campaign",""),
-            "utm_term":     meta.get("utm_term",""),
-            "utm_content":  meta.get("utm_content","")
-          },
-          "commission": {
-            "totalPriceInCents":     float(total),
-            "gatewayFeeInCents":     float(fee),
-            "userCommissionInCents": float(net),
-            "currency":              intent.currency.upper()
-          }
-        }
+        # ── Produto do upsell (catálogo em memória) ─────────────────────
+        price = found.get("catalog")
+        product_name = price["product_name"] if price and not isinstance(price, Exception) else None
+
+        # ── CAPI Purchase + UTMify paid ─────────────────────────────────
+        purchase, order = upsell_paid(intent, email, name, phone, product_name)
+
+        # ── Meta pelo lote do CAPI (enfileira), UTMify na hora ──────────
+        # (erro propaga como no checkout.session.completed)
+        outbox.enqueue("capi", purchase.to_json(), purchase.key)
+        await asyncio.wait_for(outbox.deliver("utmify", order.to_json(), order.key), FANOUT_TRACKING_TIMEOUT)
+
+def line_item_snapshot(li: dict) -> dict:
+    # line item expandido do Stripe no formato do checkout_snapshots
+    return {
+        "price_id":        li["price"]["id"],
+        "name":            li.get("description") or li["price"]["id"],
+        "nickname":        li["price"].get("nickname"),
+        "quantity":        li["quantity"],
+        "amount_subtotal": li["amount_subtotal"],
+    }
 
+async def fetch_line_items(sid: str) -> list:
+    # sem snapshot (Session criada fora daqui / expirada): busca na API
+    session = to_plain(await stripe_gw.call("checkout.sessions.retrieve", sid, params={"expand": ["line_items"]}))
+    return [line_item_snapshot(li) for li in session["line_items"]["data"]]
+
+async def charge_contact(intent_id: str, email, name, phone):
+    intent = to_plain(await stripe_gw.call(
+        "payment_intents.retrieve",
+        intent_id,
+        params={"expand": ["latest_charge"]}
+    ))
+    charges = list(((intent.get("charges") or {}).get("data") or [])[:1])
+    if isinstance(intent.get("latest_charge"), dict):
+        charges.append(intent["latest_charge"])
+    for charge in charges:
+        bd = charge.get("billing_details") or {}
+        email = email or bd.get("email") or None
+        name  = name  or bd.get("name")  or None
+        phone = phone or bd.get("phone") or None
+    return email, name, phone
+
+# ── Reconciliação: o que o Stripe tem pago e o outbox não entregou ──
+def backfill(purchase: TrackingEvent, order: Order) -> list:
+    # Purchase velho demais o Meta recusa (400 no lote inteiro): só o pedido
+    if time.time() - purchase.event_time > CAPI_MAX_EVENT_AGE:
+        return [order]
+    return [purchase, order]
+
+async def reconcile_session(session: dict) -> list:
+    if session.get("payment_status") != "paid":
+        return []
+    snapshot = checkout_snapshots.get(session["id"])
+    if snapshot is not None:
+        line_items = snapshot["line_items"]
+    else:
+        line_items = [line_item_snapshot(li) for li in (session.get("line_items") or {}).get("data", [])]
+    return backfill(*session_paid(session, line_items, session["created"]))
+
+async def reconcile_intent(intent: dict) -> list:
+    meta = intent.get("metadata") or {}
+    if intent.get("status") != "succeeded" or meta.get("upsell") != "true":
+        return []
+    # contato: cache da Session original, senão billing_details da charge
+    contact = (session_cache.get(meta.get("parent_session") or "") or {}).get("customer_details") or {}
+    charge = intent.get("latest_charge")
+    billing = (charge.get("billing_details") or {}) if isinstance(charge, dict) else {}
+    product_name = None
+    if meta.get("price_id"):
         try:
-            resp_utm = requests.post(
-              UTMIFY_API_URL,
-              headers={"Content-Type": "application/json","x-api-token": UTMIFY_API_KEY},
-              json=utmify_order_paid
-            )
-            print("→ Upsell pago enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
+            product_name = (await catalog.get(meta["price_id"]))["product_name"]
         except Exception as e:
-            print("→ UTMify (upsell) erro:", e)
-            
-    # 5) Retorna 200 sempre
+            print("→ Reconciliação: preço", meta["price_id"], e)
+    return backfill(*upsell_paid(
+        intent,
+        contact.get("email") or billing.get("email"),
+        contact.get("name") or billing.get("name"),
+        contact.get("phone") or billing.get("phone"),
+        product_name,
+        # hora da charge (pagamento); sem ela, a criação do PaymentIntent
+        charge["created"] if isinstance(charge, dict) and charge.get("created") else intent["created"],
+    ))
+
+for tenant in tenants:
+    tenant.reconciler = Reconciler(tenant.stripe_gw, tenant.outbox, {
+        "checkout.sessions.list": ({"status": "complete", "expand": ["data.line_items"]}, reconcile_session),
+        "payment_intents.list":   ({"expand": ["data.latest_charge"]}, reconcile_intent),
+    })
+reconciler = tenants.local("reconciler")
+
+@app.get("/reconcile")
+async def reconcile_stats():
+    return reconciler.stats()
+
+def event_order_key(event) -> str:
+    # eventos do mesmo customer são processados em ordem
+    obj = event["data"]["object"]
+    return object_id(obj["customer"] if "customer" in obj else None) or obj["id"]
+
+async def timed_stripe_event(event: dict):
+    t0 = time.perf_counter()
+    try:
+        with tracing.span("webhook.process", event_type=event["type"], event_id=event["id"]):
+            await process_stripe_event(event)
+    finally:
+        metrics.webhook_processing.observe(time.perf_counter() - t0, "stripe", event["type"])
+
+async def handle_webhook_job(type: str, payload: bytes):
+    await timed_stripe_event(json.loads(payload))
+
+for tenant in tenants:
+    tenant.webhook_inbox = Inbox(
+        "stripe" + tenant.suffix,
+        handle_webhook_job,
+        workers=WEBHOOK_WORKERS,
+        limits=WEBHOOK_TYPE_LIMITS,
+    )
+webhook_inbox = tenants.local("webhook_inbox")
+
+# Stripe/PayPal reentregam; processa cada evento/transação uma vez só
+webhook_dedup = DedupStore("stripe")
+paypal_dedup  = DedupStore("paypal")
+
+@app.get("/webhook/stats")
+async def webhook_stats():
+    return webhook_inbox.stats()
+
+@app.get("/dedup")
+async def dedup_stats():
+    return {"stripe": webhook_dedup.stats(), "paypal": paypal_dedup.stats()}
+
+@app.get("/customers/index")
+async def customer_index_stats():
+    return customer_index.stats()
+
+@app.post("/webhook")
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig     = request.headers.get("stripe-signature", "")
+
+    # 1) Valida a assinatura do webhook
+    try:
+        with tracing.span("webhook.verify"):
+            event = stripe.Webhook.construct_event(payload, sig, tenants.current().webhook_secret)
+    except stripe.error.SignatureVerificationError as e:
+        print("⚠️ Webhook signature mismatch:", e)
+        raise HTTPException(400, "Invalid webhook signature")
+
+    # 2) Evento já processado (retry do Stripe)? responde sem refazer nada
+    event_id = event["id"]
+    if not webhook_dedup.claim(event_id):
+        metrics.webhook_events.inc("stripe", event["type"], "duplicate")
+        return JSONResponse({"received": True, "duplicate": True})
+    metrics.webhook_events.inc("stripe", event["type"], "accepted")
+
+    # 3) Modo fast-ack: persiste o evento e responde; os workers processam
+    if WEBHOOK_ASYNC:
+        webhook_inbox.put(event["type"], event_order_key(event), payload)
+        return JSONResponse({"received": True})
+
+    try:
+        await timed_stripe_event(to_plain(event))
+    except Exception:
+        webhook_dedup.release(event_id)
+        raise
+
+    # 4) Retorna 200 sempre
     return JSONResponse({"received": True})
 
+# IPN do PayPal: o endpoint só grava o corpo cru e responde; a validação
+# (_notify-validate) e os side effects rodam nos workers do paypal_inbox
+PAYPAL_WORKERS = int(os.getenv("PAYPAL_WORKERS", "4"))
+
+# payment_status do IPN -> status do pedido na UTMify
+PAYPAL_STATUS = {
+    "Pending":   "waiting_payment",
+    "Completed": "paid",
+    "Denied":    "refused",
+    "Failed":    "refused",
+    "Expired":   "refused",
+    "Voided":    "refused",
+    "Refunded":  "refunded",
+    "Reversed":  "chargedback",
+}
+
+def paypal_dedup_key(form: dict) -> str:
+    # mesma chave no claim e no release (falha no processamento); o sufixo
+    # separa tenants (o worker roda no tenant do inbox)
+    return f"{form.get('txn_id', '')}:{form.get('payment_status') or 'unknown'}{tenants.current().suffix}"
+
 @app.post("/track-paypal")
 async def track_paypal(request: Request):
     raw_body = await request.body()
-    # 1) Validação back-and-forth com o PayPal
-    verify = requests.post(
-        "https://ipnpb.paypal.com/cgi-bin/webscr",
-        data=b"cmd=_notify-validate&" + raw_body,
+    form = dict(urllib.parse.parse_qsl(raw_body.decode()))
+
+    # persiste todo IPN e responde; o dedup só roda no worker, depois da
+    # verificação (um IPN forjado não pode ocupar a chave do verdadeiro).
+    # Reembolsos ficam na lane da transação original
+    ipn_type = form.get("payment_status") or "unknown"
+    metrics.webhook_events.inc("paypal", ipn_type, "accepted")
+    paypal_inbox.put(ipn_type, form.get("parent_txn_id") or form.get("txn_id", ""), raw_body)
+    return JSONResponse({"status": "ok"})
+
+async def handle_paypal_job(type: str, payload: bytes):
+    t0 = time.perf_counter()
+    try:
+        with tracing.span("paypal.process", payment_status=type):
+            form = dict(urllib.parse.parse_qsl(payload.decode()))
+            await process_paypal_ipn(payload, form, paypal_dedup_key(form))
+    finally:
+        metrics.webhook_processing.observe(time.perf_counter() - t0, "paypal", type)
+
+for tenant in tenants:
+    tenant.paypal_inbox = Inbox("paypal" + tenant.suffix, handle_paypal_job, workers=PAYPAL_WORKERS)
+paypal_inbox = tenants.local("paypal_inbox")
+
+# txn_id -> data da transação original, p/ mudança de status e reembolso não
+# sobrescreverem o createdAt do pedido na UTMify
+PAYPAL_ORDER_TTL = float(os.getenv("PAYPAL_ORDER_TTL", str(400 * 24 * 3600)))
+for tenant in tenants:
+    tenant.paypal_orders = KVCache("paypal_orders" + tenant.suffix, ttl=PAYPAL_ORDER_TTL)
+paypal_orders = tenants.local("paypal_orders")
+
+# fuso do payment_date do IPN (horário do Pacífico)
+PAYPAL_TZ = {"PST": -8, "PDT": -7}
+
+def paypal_time(value: str):
+    # "18:30:30 Feb 28, 2023 PST" -> epoch; None se ausente/inválido
+    try:
+        clock, tz = value.rsplit(" ", 1)
+        return calendar.timegm(time.strptime(clock, "%H:%M:%S %b %d, %Y")) - PAYPAL_TZ.get(tz, -8) * 3600
+    except (AttributeError, ValueError):
+        return None
+
+@app.get("/paypal/stats")
+async def paypal_stats():
+    return paypal_inbox.stats()
+
+async def process_paypal_ipn(raw_body: bytes, form: dict, dedup_key: str):
+    txn_id = form.get("txn_id", "")
+    payment_status = form.get("payment_status", "")
+    # 1) Validação back-and-forth com o PayPal (erro de rede = retry do inbox)
+    verify = await dependencies["paypal"].call(
+        http.post,
+        PAYPAL_IPN_URL,
+        op="notify_validate",
+        content=b"cmd=_notify-validate&" + raw_body,
         headers={"Content-Type": "application/x-www-form-urlencoded"}
     )
+    verify.raise_for_status()
     if verify.text != "VERIFIED":
-        return JSONResponse(status_code=400, content={"status": "invalid ipn"})
+        print("⚠️ IPN inválido:", txn_id, payment_status, verify.text)
+        return
 
-    # 2) Parse dos dados do IPN
-    form = dict(urllib.parse.parse_qsl(raw_body.decode()))
-    utm_source       = form.get("custom_utm_source", "")
-    utm_medium       = form.get("custom_utm_medium", "")
-    utm_campaign     = form.get("custom_utm_campaign", "")
-    utm_term         = form.get("custom_utm_term", "")
-    utm_content      = form.get("custom_utm_content", "")
-
-    # ───────────────────────────────────────────────────────────
-    # 2.5) Dispara o Purchase para a Meta (Facebook) Conversion API
-    purchase_payload = {
-      "data": [{
-        "event_name":    "Purchase",
-        "event_time":    int(time.time()),
-        "event_id":      form.get("txn_id", ""),              # ID da transação PayPal
-        "action_source": "website",
-        "event_source_url": form.get("return_url", ""),
-        "user_data": {
-          "em": hashlib.sha256(
-                  form.get("payer_email", "").encode("utf-8")
-                ).hexdigest()
-        },
-        "custom_data": {
-          "currency": form.get("mc_currency", ""),
-          "value":    float(form.get("mc_gross", 0)),
-          "content_ids": [ form.get("item_number", "") ],
-          "content_type": "product"
-        }
-      }]
-    }
-    requests.post(
-      f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-      params={"access_token": ACCESS_TOKEN},
-      json=purchase_payload
-    )
+    # 1.5) IPN reenviado? o mesmo txn_id volta com outro payment_status
+    #      quando a transação muda (Pending -> Completed -> Refunded)
+    if txn_id and not paypal_dedup.claim(dedup_key):
+        metrics.webhook_events.inc("paypal", payment_status or "unknown", "duplicate")
+        return
+    try:
+        await record_paypal_ipn(form)
+    except Exception:
+        # deixa o retry do inbox processar de novo
+        if txn_id:
+            paypal_dedup.release(dedup_key)
+        raise
 
-    # 2.5.1) Cria pedido inicial no UTMify (PayPal)
+async def record_paypal_ipn(form: dict):
     txn_id = form.get("txn_id", "")
-    created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    utmify_order = {
-      "orderId":       txn_id,
-      "platform":      "PayPal",
-      "paymentMethod": "paypal",
-      "status":        "waiting_payment",
-      "createdAt":     created_at,
-      "approvedDate":  None,
-      "refundedAt":    None,
-      "customer": {
-        "email": form.get("payer_email", "")
-      },
-      "products": [
-        {
-          "id":           form.get("item_number", ""),
-          "name":         form.get("item_name", ""),
-          "quantity":     int(form.get("quantity", 1)),
-          "priceInCents": int(float(form.get("mc_gross", 0)) * 100)
-        }
-      ],
-      "trackingParameters": {
-        "utm_source":      utm_source,
-        "utm_medium":      utm_medium,
-        "utm_campaign":    utm_campaign,
-        "utm_term":        utm_term,
-        "utm_content":     utm_content
-      },
-      "commission": {
-        "totalPriceInCents":     int(float(form.get("mc_gross", 0)) * 100),
-        "gatewayFeeInCents":     0,
-        "userCommissionInCents": 0,
-        "currency":              form.get("mc_currency", "").upper()
-      }
-    }
-    resp_utm = requests.post(
-      UTMIFY_API_URL,
-      headers={
-        "Content-Type":  "application/json",
-        "x-api-token":   UTMIFY_API_KEY
-      },
-      json=utmify_order
-    )
-    print("→ Pedido inicial (PayPal) enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
-    # ───────────────────────────────────────────────────────────
-
-    # 3) Cria o cliente na Stripe
-    stripe.api_key = STRIPE_SECRET_KEY
-    stripe.Customer.create(
-        email=form.get("payer_email"),
-        metadata={
-            "utm_source":   utm_source,
-            "utm_medium":   utm_medium,
-            "utm_campaign": utm_campaign,
-            "utm_term":     utm_term,
-            "utm_content":  utm_content,
-            "origin":       "paypal"
-        }
+    payment_status = form.get("payment_status", "")
+    status = PAYPAL_STATUS.get(payment_status)
+    if status is None:
+        print("→ IPN ignorado:", txn_id, payment_status)
+        return
+
+    # 2) Dados do IPN; reembolso/estorno chega com txn_id próprio e aponta
+    #    p/ a transação original em parent_txn_id
+    order_id = form.get("parent_txn_id") or txn_id
+    tracking = tracking_parameters(form, prefix="custom_")
+    gross = abs(float(form.get("mc_gross", 0) or 0))
+    gross_in_cents = int(round(gross * 100))
+    payer_email = form.get("payer_email", "")
+
+    # 2.5) Purchase para a Meta só quando o pagamento conclui
+    if status == "paid":
+        purchase = TrackingEvent(
+            event_name="Purchase",
+            event_id=order_id,                        # ID da transação PayPal
+            event_source_url=form.get("return_url", ""),
+            user_data={
+              "em": hashlib.sha256(payer_email.encode("utf-8")).hexdigest()
+            },
+            currency=form.get("mc_currency", ""),
+            value=gross,
+            content_ids=[form.get("item_number", "")],
+        )
+        # lote do CAPI: enfileira em vez de esperar o timer do lote
+        outbox.enqueue("capi", purchase.to_json(), purchase.key)
+
+    # 2.5.1) Pedido na UTMify com o status da transação. createdAt é sempre o
+    #        da transação original (o reembolso traz a data dele mesmo)
+    event_at = paypal_time(form.get("payment_date")) or time.time()
+    original = paypal_orders.get(order_id)
+    if original is None:
+        original = {"created": event_at}
+        if order_id == txn_id:
+            paypal_orders.set(order_id, original)
+    order = Order(
+        order_id=order_id,
+        platform="PayPal",
+        payment_method="paypal",
+        status=status,
+        created_at=utc(original["created"]),
+        approved_date=utc(event_at) if status == "paid" else None,
+        refunded_at=utc(event_at) if status in ("refunded", "chargedback") else None,
+        customer=Customer(email=payer_email),
+        products=[Product(
+            id=form.get("item_number", ""),
+            name=form.get("item_name", ""),
+            quantity=int(form.get("quantity", 1) or 1),
+            price_in_cents=gross_in_cents,
+        )],
+        tracking=tracking,
+        total_in_cents=gross_in_cents,
+        currency=form.get("mc_currency", ""),
     )
-    return JSONResponse({"status": "ok"})
+    await outbox.deliver("utmify", order.to_json(), order.key)
+
+    # 3) Cliente na Stripe: atualiza o existente (índice local) ou cria
+    if status in ("waiting_payment", "paid"):
+        metadata = {**tracking, "origin": "paypal"}
+        if payer_email:
+            await customer_index.upsert(payer_email, metadata)
+        else:
+            await stripe_gw.call("customers.create", params={"metadata": metadata})
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,193 @@
+import asyncio
+import bisect
+import os
+import time
+
+# Métricas em memória no formato texto do Prometheus (GET /metrics). Sem
+# dependência extra: contadores/histogramas são dicts indexados pela tupla de
+# labels, e o observe() no hot path é um bisect + dois incrementos.
+METRICS_LOOP_INTERVAL = float(os.getenv("METRICS_LOOP_INTERVAL", "0.5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        # collect: fn() -> {labels: valor}, lido só na hora do scrape
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def render(self) -> list:
+        values = self.collect() if self.collect is not None else self.values
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {value}"
+            for labels, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            # contagens por bucket (não cumulativas) + [sum, count]
+            entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def render(self) -> list:
+        lines = self.header()
+        for labels, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), entry):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {entry[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {entry[-1]}")
+        return lines
+
+
+registry: list = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+# ── Métricas do app ────────────────────────────────────────────────
+http_requests = Histogram(
+    "http_request_duration_seconds", "Latência dos requests por rota", ("route", "method", "status"))
+http_inflight = Gauge(
+    "http_requests_in_flight", "Requests em andamento por rota", ("route",))
+outbound_latency = Histogram(
+    "outbound_call_duration_seconds", "Latência das chamadas externas por dependência/método",
+    ("dependency", "method"))
+outbound_errors = Counter(
+    "outbound_call_errors_total", "Falhas das chamadas externas", ("dependency", "method", "reason"))
+webhook_events = Counter(
+    "webhook_events_total", "Eventos de webhook recebidos por tipo", ("source", "type", "result"))
+webhook_processing = Histogram(
+    "webhook_processing_seconds", "Tempo de processamento dos eventos por tipo", ("source", "type"))
+admission_shed = Counter(
+    "stripe_admission_shed_total", "Chamadas ao Stripe recusadas pelo controle de admissão", ("priority",))
+admission_wait = Histogram(
+    "stripe_admission_wait_seconds", "Espera na fila de admissão do Stripe", ("priority",))
+coalesced = Counter(
+    "coalesced_requests_total", "Requests por endpoint: executados, juntados a um em voo ou do cache curto",
+    ("endpoint", "result"))
+loop_lag = Histogram(
+    "event_loop_lag_seconds", "Atraso do event loop (sleep agendado vs. acordado)", (),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+loop_lag_last = Gauge("event_loop_lag_last_seconds", "Último atraso medido do event loop")
+
+
+class MetricsMiddleware:
+    # ASGI puro: latência por rota (template do path, não o path cru) e
+    # requests em andamento; paths desconhecidos viram "other"
+    def __init__(self, app):
+        self.app = app
+        self._paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self._paths is None:
+            self._paths = {r.path for r in scope["app"].routes if "{" not in r.path}
+        path = scope["path"] if scope["path"] in self._paths else "other"
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        http_inflight.inc(path)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_inflight.dec(path)
+            route = scope.get("route")
+            http_requests.observe(
+                time.perf_counter() - t0,
+                getattr(route, "path", "other"), scope["method"], status[0],
+            )
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = METRICS_LOOP_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - t0 - self.interval)
+            loop_lag.observe(lag)
+            loop_lag_last.set(value=lag)
@@ -0,0 +1,168 @@
+import json
+import time
+from dataclasses import dataclass, field
+
+try:
+    import orjson
+except ImportError:          # sem orjson: cai no json da stdlib
+    orjson = None
+
+# Modelos de pedido (UTMify) e evento (Meta CAPI). Serializam uma vez p/ bytes
+# e o mesmo buffer é reaproveitado pelo outbox nas retentativas.
+
+TRACKING_KEYS = ("utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content")
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def utc(ts: float = None) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+
+def tracking_parameters(meta: dict, prefix: str = "") -> dict:
+    # UTMs com o formato que a UTMify espera; prefix p/ "custom_" do PayPal
+    return {key: meta.get(prefix + key) or "" for key in TRACKING_KEYS}
+
+
+@dataclass(slots=True)
+class Customer:
+    name: str = ""
+    email: str = ""
+    phone: str = None
+    document: str = None
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "email": self.email, "phone": self.phone, "document": self.document}
+
+
+@dataclass(slots=True)
+class Product:
+    id: str
+    name: str
+    quantity: int
+    price_in_cents: int
+    plan_id: str = None
+    plan_name: str = None
+
+    @classmethod
+    def from_line_item(cls, li: dict) -> "Product":
+        # li no formato do snapshot gravado pelo /create-checkout-session
+        return cls(
+            id=li["price_id"],
+            name=li["name"],
+            plan_id=li["price_id"],
+            plan_name=li["nickname"],
+            quantity=li["quantity"],
+            price_in_cents=li["amount_subtotal"],
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id":           self.id,
+            "name":         self.name,
+            "planId":       self.plan_id,
+            "planName":     self.plan_name,
+            "quantity":     self.quantity,
+            "priceInCents": self.price_in_cents,
+        }
+
+
+@dataclass(slots=True)
+class Order:
+    order_id: str
+    platform: str
+    payment_method: str
+    status: str
+    created_at: str
+    customer: Customer
+    products: list
+    tracking: dict
+    total_in_cents: int
+    currency: str
+    approved_date: str = None
+    refunded_at: str = None
+    gateway_fee_in_cents: int = 0
+    user_commission_in_cents: int = 0
+    _json: bytes = field(default=None, repr=False, compare=False)
+
+    @property
+    def key(self) -> str:
+        return f"{self.order_id}:{self.status}"
+
+    def apply_fee(self, rate: float) -> "Order":
+        # comissão em centavos inteiros (sem misturar Decimal e float)
+        self.gateway_fee_in_cents = round(self.total_in_cents * rate)
+        self.user_commission_in_cents = self.total_in_cents - self.gateway_fee_in_cents
+        self._json = None
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "orderId":            self.order_id,
+            "platform":           self.platform,
+            "paymentMethod":      self.payment_method,
+            "status":             self.status,
+            "createdAt":          self.created_at,
+            "approvedDate":       self.approved_date,
+            "refundedAt":         self.refunded_at,
+            "customer":           self.customer.to_dict(),
+            "products":           [p.to_dict() for p in self.products],
+            "trackingParameters": self.tracking,
+            "commission": {
+                "totalPriceInCents":     self.total_in_cents,
+                "gatewayFeeInCents":     self.gateway_fee_in_cents,
+                "userCommissionInCents": self.user_commission_in_cents,
+                "currency":              self.currency.upper(),
+            },
+        }
+
+    def to_json(self) -> bytes:
+        if self._json is None:
+            self._json = dumps(self.to_dict())
+        return self._json
+
+
+@dataclass(slots=True)
+class TrackingEvent:
+    event_name: str
+    event_id: str
+    currency: str
+    value: float
+    content_ids: list
+    user_data: dict
+    event_time: int = field(default_factory=lambda: int(time.time()))
+    event_source_url: str = None
+    action_source: str = "website"
+    _json: bytes = field(default=None, repr=False, compare=False)
+
+    @property
+    def key(self) -> str:
+        # o Meta deduplica por (event_name, event_id)
+        return f"{self.event_name}:{self.event_id}"
+
+    def to_dict(self) -> dict:
+        event = {
+            "event_name":    self.event_name,
+            "event_time":    self.event_time,
+            "event_id":      self.event_id,
+            "action_source": self.action_source,
+            "user_data":     self.user_data,
+            "custom_data": {
+                "currency":     self.currency,
+                "value":        self.value,
+                "content_ids":  self.content_ids,
+                "content_type": "product",
+            },
+        }
+        if self.event_source_url is not None:
+            event["event_source_url"] = self.event_source_url
+        return event
+
+    def to_json(self) -> bytes:
+        if self._json is None:
+            self._json = dumps(self.to_dict())
+        return self._json
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import random
+import time
+
+import store
+from resilience import CircuitOpenError
+
+# Outbox durável p/ side effects de tracking (CAPI, UTMify). O handler grava o
+# payload no SQLite e segue a vida; o dispatcher em background entrega com
+# retry + backoff exponencial. Linhas pendentes sobrevivem a restart. Com o
+# breaker do destino aberto a entrega é adiada sem gastar tentativa.
+OUTBOX_MAX_ATTEMPTS   = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12"))
+OUTBOX_BASE_DELAY     = float(os.getenv("OUTBOX_BASE_DELAY", "2"))
+OUTBOX_MAX_DELAY      = float(os.getenv("OUTBOX_MAX_DELAY", "900"))
+OUTBOX_CONCURRENCY    = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+OUTBOX_POLL_INTERVAL  = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_BATCH          = int(os.getenv("OUTBOX_BATCH", "1000"))
+# por quanto tempo lembrar o que já foi entregue (usado pela reconciliação)
+OUTBOX_DELIVERED_TTL  = float(os.getenv("OUTBOX_DELIVERED_TTL", str(400 * 24 * 3600)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind            TEXT    NOT NULL,
+    key             TEXT,
+    payload         BLOB    NOT NULL,
+    created_at      REAL    NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,
+    last_error      TEXT,
+    state           TEXT    NOT NULL DEFAULT 'pending'
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_key ON outbox (kind, key);
+CREATE TABLE IF NOT EXISTS delivered (
+    kind         TEXT NOT NULL,
+    key          TEXT NOT NULL,
+    delivered_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS delivered_age ON delivered (delivered_at);
+"""
+
+
+class PermanentDeliveryError(Exception):
+    # o destino rejeitou o payload; não adianta tentar de novo
+    pass
+
+
+class Outbox:
+    def __init__(self, senders: dict, db: str = "outbox",
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 base_delay: float = OUTBOX_BASE_DELAY,
+                 max_delay: float = OUTBOX_MAX_DELAY,
+                 concurrency: int = OUTBOX_CONCURRENCY,
+                 limits: dict = None,
+                 breakers: dict = None,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        # senders: kind -> async fn(body: bytes, key: str); exceção = falha de entrega
+        # limits: concorrência por kind (default: concurrency)
+        # breakers: kind -> CircuitBreaker do destino
+        self.senders = senders
+        self.db = db
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self.limits = limits or {}
+        self.breakers = breakers or {}
+        self.poll_interval = poll_interval
+        self.delivered = 0
+        self.failed = 0
+        self.deferred = 0
+        self._conn = None
+        self._inflight: set[int] = set()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._jobs: set[asyncio.Task] = set()
+        self._sems = {}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = store.connect(self.db)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    # ── API usada pelos handlers ────────────────────────────────────
+    def enqueue(self, kind: str, body: bytes, key: str = None) -> int:
+        # body já serializado (models.*.to_json()); é o mesmo buffer nos retries
+        if kind not in self.senders:
+            raise ValueError(f"unknown outbox kind: {kind}")
+        now = time.time()
+        cur = self.conn.execute(
+            "INSERT INTO outbox (kind, key, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, key, body, now, now),
+        )
+        self._wake.set()
+        return cur.lastrowid
+
+    async def deliver(self, kind: str, body: bytes, key: str = None) -> bool:
+        # grava e já tenta entregar; se falhar fica no outbox p/ o dispatcher
+        row_id = self.enqueue(kind, body, key)
+        breaker = self.breakers.get(kind)
+        if breaker is not None and breaker.blocked:
+            self._defer(row_id, kind, breaker.retry_after())
+            return False
+        self._inflight.add(row_id)
+        try:
+            return await self._attempt(row_id, kind, body, key, 0)
+        finally:
+            self._inflight.discard(row_id)
+
+    def has(self, kind: str, key: str) -> bool:
+        # já entregue, ou pendente de entrega (não conta o que morreu)
+        if self.conn.execute(
+            "SELECT 1 FROM delivered WHERE kind = ? AND key = ?", (kind, key)
+        ).fetchone():
+            return True
+        return self.conn.execute(
+            "SELECT 1 FROM outbox WHERE kind = ? AND key = ? AND state = 'pending' LIMIT 1", (kind, key)
+        ).fetchone() is not None
+
+    def depth(self) -> int:
+        depth, = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()
+        return depth
+
+    def purge_delivered(self, now: float = None):
+        self.conn.execute(
+            "DELETE FROM delivered WHERE delivered_at < ?", ((now or time.time()) - OUTBOX_DELIVERED_TTL,)
+        )
+
+    def stats(self) -> dict:
+        now = time.time()
+        by_kind = {
+            kind: {"depth": depth, "lag_seconds": round(now - oldest, 3)}
+            for kind, depth, oldest in self.conn.execute(
+                "SELECT kind, COUNT(*), MIN(created_at) FROM outbox WHERE state = 'pending' GROUP BY kind"
+            )
+        }
+        dead, = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'dead'").fetchone()
+        return {
+            "depth":       sum(k["depth"] for k in by_kind.values()),
+            "lag_seconds": max((k["lag_seconds"] for k in by_kind.values()), default=0.0),
+            "dead":        dead,
+            "inflight":    len(self._inflight),
+            "delivered":   self.delivered,
+            "failed":      self.failed,
+            "deferred":    self.deferred,
+            "by_kind":     by_kind,
+        }
+
+    # ── Dispatcher ──────────────────────────────────────────────────
+    def start(self):
+        if self._task is None:
+            self._sems = {
+                kind: asyncio.Semaphore(self.limits.get(kind, self.concurrency))
+                for kind in self.senders
+            }
+            self.purge_delivered()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # entregas em andamento voltam a ficar pendentes p/ o próximo start
+        jobs = list(self._jobs)
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                await self._dispatch_due()
+            except Exception as e:
+                print("→ Outbox dispatcher erro:", e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._sleep_for())
+            except asyncio.TimeoutError:
+                pass
+
+    def _sleep_for(self) -> float:
+        # próxima linha devida que ainda não está em andamento
+        for row_id, next_attempt_at in self.conn.execute(
+            "SELECT id, next_attempt_at FROM outbox WHERE state = 'pending' ORDER BY next_attempt_at LIMIT ?",
+            (len(self._inflight) + 1,),
+        ):
+            if row_id not in self._inflight:
+                return min(self.poll_interval, max(0.05, next_attempt_at - time.time()))
+        return self.poll_interval
+
+    async def _dispatch_due(self):
+        # cada linha vira uma task (limitada pelo semáforo do kind): um envio
+        # lento não segura as linhas que chegam depois
+        rows = self.conn.execute(
+            "SELECT id, kind, payload, key, attempts FROM outbox "
+            "WHERE state = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (time.time(), OUTBOX_BATCH),
+        ).fetchall()
+        for row_id, kind, body, key, attempts in rows:
+            if row_id in self._inflight:
+                continue
+            breaker = self.breakers.get(kind)
+            if breaker is not None and breaker.blocked:
+                self._defer(row_id, kind, breaker.retry_after())
+                continue
+            self._inflight.add(row_id)
+            job = asyncio.create_task(self._dispatch_one(row_id, kind, body, key, attempts))
+            self._jobs.add(job)
+            job.add_done_callback(self._jobs.discard)
+
+    async def _dispatch_one(self, row_id, kind, body, key, attempts):
+        try:
+            async with self._sems[kind]:
+                await self._attempt(row_id, kind, body, key, attempts)
+        finally:
+            self._inflight.discard(row_id)
+            # retry reagendado ou fila andou: o dispatcher recalcula a espera
+            self._wake.set()
+
+    async def _attempt(self, row_id, kind, body, key, attempts) -> bool:
+        try:
+            await self.senders[kind](body, key)
+        except CircuitOpenError as e:
+            self._defer(row_id, kind, e.retry_after)
+            return False
+        except Exception as e:
+            self._failed(row_id, kind, attempts + 1, e)
+            return False
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        if key is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO delivered (kind, key, delivered_at) VALUES (?, ?, ?)",
+                (kind, key, time.time()),
+            )
+        self.delivered += 1
+        return True
+
+    def _failed(self, row_id, kind, attempts, error):
+        self.failed += 1
+        if attempts >= self.max_attempts or isinstance(error, PermanentDeliveryError):
+            print(f"→ Outbox {kind} #{row_id} desistiu após {attempts} tentativas:", error)
+            self.conn.execute(
+                "UPDATE outbox SET state = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                (attempts, str(error), row_id),
+            )
+            return
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        print(f"→ Outbox {kind} #{row_id} falhou (tentativa {attempts}), retry em {delay:.1f}s:", error)
+        self.conn.execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (attempts, time.time() + delay, str(error), row_id),
+        )
+
+    def _defer(self, row_id, kind, delay):
+        # destino indisponível: reagenda p/ quando o breaker tentar de novo
+        self.deferred += 1
+        self.conn.execute(
+            "UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (time.time() + max(delay, 1.0), f"{kind}: circuit open", row_id),
+        )
@@ -0,0 +1,67 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Profiler por amostragem sob demanda (POST /admin/profile): uma thread lê a
+# pilha das outras threads a cada PROFILE_INTERVAL durante alguns segundos e
+# devolve as pilhas no formato "collapsed" (uma linha "f1;f2;f3 N" por pilha),
+# que o flamegraph.pl, o speedscope e o inferno leem direto. Parado, não
+# custa nada: não há hook nem thread rodando.
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL    = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, max_seconds: float = PROFILE_MAX_SECONDS):
+        self.max_seconds = max_seconds
+        self.runs = 0
+        self.last = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, interval: float = PROFILE_INTERVAL, threads: set = None) -> dict:
+        # bloqueante: chamar numa thread (asyncio.to_thread). threads = idents
+        # a amostrar; None = todas menos a própria
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("profile already running")
+        try:
+            me = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = collections.Counter()
+            samples = 0
+            t0 = time.monotonic()
+            deadline = t0 + min(seconds, self.max_seconds)
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me or (threads is not None and ident not in threads):
+                        continue
+                    parts = []
+                    while frame is not None:
+                        parts.append(_frame_name(frame))
+                        frame = frame.f_back
+                    parts.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(parts))] += 1
+                samples += 1
+                time.sleep(interval)
+            self.runs += 1
+            self.last = {"seconds": round(time.monotonic() - t0, 2), "samples": samples, "stacks": len(stacks)}
+            return stacks
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(stacks: dict) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def stats(self) -> dict:
+        return {"running": self.running, "runs": self.runs, "last": self.last}
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import datetime
+import os
+import time
+
+from admission import set_priority, BACKGROUND
+from models import TrackingEvent
+from stripe_gateway import to_plain
+
+# Reconciliação: varre Sessions/PaymentIntents do Stripe numa janela de tempo
+# (página a página, memória constante) e compara com o registro de entregas do
+# outbox. O que não foi entregue nem está pendente (UTMify/Meta fora do ar,
+# linha morta, webhook perdido) é reenfileirado; o dispatcher do outbox entrega
+# com os limites por kind, e o CAPI sai em lotes pelo batcher.
+RECONCILE_EVERY   = float(os.getenv("RECONCILE_EVERY", "0"))          # s; 0 = só pela CLI
+RECONCILE_WINDOW  = float(os.getenv("RECONCILE_WINDOW", str(3 * 24 * 3600)))
+RECONCILE_GRACE   = float(os.getenv("RECONCILE_GRACE", "900"))        # o webhook ainda pode estar em voo
+RECONCILE_BACKLOG = int(os.getenv("RECONCILE_BACKLOG", "5000"))       # pausa a varredura acima disso
+
+
+class Reconciler:
+    def __init__(self, gateway, outbox, sources: dict,
+                 every: float = RECONCILE_EVERY, window: float = RECONCILE_WINDOW,
+                 grace: float = RECONCILE_GRACE, backlog: int = RECONCILE_BACKLOG):
+        # sources: método de list do Stripe -> (params, async fn(obj: dict) -> [Order|TrackingEvent])
+        self.gateway = gateway
+        self.outbox = outbox
+        self.sources = sources
+        self.every = every
+        self.window = window
+        self.grace = grace
+        self.backlog = backlog
+        self.last_run = None
+        self._task = None
+
+    async def run(self, since: float, until: float, dry_run: bool = False) -> dict:
+        set_priority(BACKGROUND)
+        t0 = time.monotonic()
+        report = {"since": int(since), "until": int(until), "scanned": {}, "missing": {"capi": 0, "utmify": 0}}
+        for method, (params, build) in self.sources.items():
+            scanned = 0
+            async for obj in self.gateway.paginate(method, params={
+                **params, "limit": 100, "created": {"gte": int(since), "lt": int(until)},
+            }):
+                scanned += 1
+                for model in await build(to_plain(obj)):
+                    kind = "capi" if isinstance(model, TrackingEvent) else "utmify"
+                    if self.outbox.has(kind, model.key):
+                        continue
+                    report["missing"][kind] += 1
+                    if not dry_run:
+                        self.outbox.enqueue(kind, model.to_json(), model.key)
+                if scanned % 100 == 0:
+                    await self._backpressure()
+            report["scanned"][method] = scanned
+        report["seconds"] = round(time.monotonic() - t0, 1)
+        self.last_run = report
+        print("→ Reconciliação:", report)
+        return report
+
+    async def _backpressure(self):
+        # não deixa a varredura encher o outbox mais rápido do que ele entrega
+        while self.outbox.depth() > self.backlog:
+            await asyncio.sleep(1)
+
+    def start(self):
+        if self.every > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.every)
+            until = time.time() - self.grace
+            try:
+                await self.run(until - self.window, until)
+            except Exception as e:
+                print("→ Reconciliação erro:", e)
+
+    def stats(self) -> dict:
+        return {"every": self.every, "window": self.window, "last_run": self.last_run}
+
+
+def _timestamp(value: str) -> float:
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+async def _cli(args):
+    import main
+
+    tenant = main.tenants.get(args.tenant)
+    if tenant is None:
+        raise SystemExit(f"tenant desconhecido: {args.tenant}")
+    now = time.time()
+    until = _timestamp(args.until) if args.until else now - RECONCILE_GRACE
+    since = _timestamp(args.since) if args.since else until - args.days * 24 * 3600
+    with main.tenants.active(tenant):
+        tenant.outbox.start()
+        try:
+            await tenant.reconciler.run(since, until, dry_run=args.dry_run)
+            # espera o outbox esvaziar (ou desistir) antes de sair
+            deadline = time.monotonic() + args.drain_timeout
+            while tenant.outbox.depth() and time.monotonic() < deadline:
+                await asyncio.sleep(1)
+            print("→ Outbox:", tenant.outbox.stats())
+        finally:
+            await tenant.outbox.stop()
+            await tenant.capi.flush()
+            await main.http.aclose()
+            await tenant.stripe_gw.aclose()
+
+
+if __name__ == "__main__":
+    # python -m reconcile --days 30
+    # python -m reconcile --since 2025-01-01 --until 2025-02-01 --dry-run
+    # python -m reconcile --tenant loja2 --days 7
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--since", help="data/hora ISO (UTC)")
+    parser.add_argument("--until", help="data/hora ISO (UTC); default: agora - RECONCILE_GRACE")
+    parser.add_argument("--days", type=float, default=RECONCILE_WINDOW / 86400)
+    parser.add_argument("--dry-run", action="store_true", help="só conta o que falta")
+    parser.add_argument("--drain-timeout", type=float, default=600)
+    parser.add_argument("--tenant", default="default")
+    asyncio.run(_cli(parser.parse_args()))
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import contextvars
+import os
+import random
+import time
+
+import httpx
+
+import metrics
+import tracing
+
+# Camada de resiliência por dependência (Stripe, CAPI, UTMify, PayPal): timeout
+# limitado pelo deadline do request de entrada, retry com jitter dentro de um
+# orçamento, e circuit breaker que falha rápido quando o destino está doente
+# (o outbox usa isso p/ adiar a entrega em vez de queimar tentativas).
+REQUEST_DEADLINE      = float(os.getenv("REQUEST_DEADLINE", "25"))
+RETRY_BUDGET_RATIO    = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN      = float(os.getenv("RETRY_BUDGET_MIN", "1"))     # retries/s garantidos
+BREAKER_FAILURE_RATE  = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_CALLS     = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_WINDOW        = float(os.getenv("BREAKER_WINDOW", "30"))
+BREAKER_OPEN_FOR      = float(os.getenv("BREAKER_OPEN_FOR", "30"))
+
+# deadline absoluto (time.monotonic) do request atual; None = sem limite
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+TRANSIENT = (asyncio.TimeoutError, httpx.TransportError, ConnectionError)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name}: circuit open, retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def remaining(default: float = None) -> float:
+    # quanto resta do deadline do request (limitado por default)
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return left if default is None else min(default, left)
+
+
+def _expired(margin: float = 0.0) -> bool:
+    deadline = _deadline.get()
+    return deadline is not None and deadline - time.monotonic() <= margin
+
+
+def set_deadline(seconds: float):
+    # só encurta: um deadline herdado nunca é estendido
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    return _deadline.set(deadline if current is None else min(current, deadline))
+
+
+def clear_deadline():
+    # p/ tasks de background criadas dentro de um request
+    _deadline.set(None)
+
+
+class DeadlineMiddleware:
+    # ASGI puro: define o deadline do request (header X-Request-Timeout em
+    # segundos, limitado por REQUEST_DEADLINE) antes de chamar o app
+    def __init__(self, app, default: float = REQUEST_DEADLINE):
+        self.app = app
+        self.default = default
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        seconds = self.default
+        for name, value in scope["headers"]:
+            if name == b"x-request-timeout":
+                try:
+                    seconds = min(seconds, float(value))
+                except ValueError:
+                    pass
+                break
+        token = set_deadline(seconds)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _deadline.reset(token)
+
+
+class RetryBudget:
+    # cada chamada deposita `ratio` tokens, cada retry gasta 1; com o destino
+    # fora do ar os retries ficam em ~ratio do tráfego em vez de multiplicá-lo
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO,
+                 min_per_sec: float = RETRY_BUDGET_MIN, cap: float = 10.0):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.cap = cap
+        self.tokens = cap
+        self._at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self._at) * self.min_per_sec)
+        self._at = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class CircuitBreaker:
+    # closed -> open quando a taxa de falha na janela passa do limite;
+    # open -> half_open depois de open_for; uma sonda decide se fecha
+    def __init__(self, name: str,
+                 failure_rate: float = BREAKER_FAILURE_RATE,
+                 min_calls: int = BREAKER_MIN_CALLS,
+                 window: float = BREAKER_WINDOW,
+                 open_for: float = BREAKER_OPEN_FOR):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_for = open_for
+        self.state = "closed"
+        self.opened = 0
+        self._calls = collections.deque(maxlen=1000)   # (t, ok)
+        self._open_until = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() < self._open_until:
+                return False
+            self.state = "half_open"
+        # half_open: uma sonda por vez
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    @property
+    def blocked(self) -> bool:
+        return self.state == "open" and time.monotonic() < self._open_until
+
+    def cancel(self):
+        # chamada cancelada/sem veredito: libera a sonda do half_open
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self._open_until - time.monotonic())
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._probing = False
+            if ok:
+                self.state = "closed"
+                self._calls.clear()
+            else:
+                self._trip(now)
+            return
+        self._calls.append((now, ok))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        if not ok and self.state == "closed" and len(self._calls) >= self.min_calls:
+            failures = sum(1 for _, ok in self._calls if not ok)
+            if failures / len(self._calls) >= self.failure_rate:
+                self._trip(now)
+
+    def _trip(self, now: float):
+        print(f"→ Breaker {self.name} aberto por {self.open_for:g}s")
+        self.state = "open"
+        self.opened += 1
+        self._open_until = now + self.open_for
+        self._calls.clear()
+
+    def stats(self) -> dict:
+        failures = sum(1 for _, ok in self._calls if not ok)
+        return {
+            "state":       self.state,
+            "calls":       len(self._calls),
+            "failures":    failures,
+            "opened":      self.opened,
+            "retry_after": round(self.retry_after(), 1) if self.state == "open" else 0.0,
+        }
+
+
+class Dependency:
+    def __init__(self, name: str, timeout: float, retries: int = 2,
+                 base_delay: float = 0.2, max_delay: float = 2.0,
+                 transient: tuple = TRANSIENT):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.transient = transient
+        self.breaker = CircuitBreaker(name)
+        self.budget = RetryBudget()
+        self.calls = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def _failed(self, result) -> bool:
+        # respostas HTTP 429/5xx contam como falha do destino
+        status = getattr(result, "status_code", None)
+        return status is not None and (status == 429 or status >= 500)
+
+    async def call(self, fn, *args, timeout: float = None, idempotent: bool = True,
+                   op: str = "call", **kwargs):
+        # fn: async fn(*args, **kwargs); só repete se idempotent; op = label
+        # da métrica (ex.: método do Stripe)
+        budget_s = self.timeout if timeout is None else timeout
+        self.calls += 1
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.rejected += 1
+                metrics.outbound_errors.inc(self.name, op, "circuit_open")
+                raise CircuitOpenError(self.name, self.breaker.retry_after())
+            t0 = time.perf_counter()
+            # um span por tentativa: retries aparecem lado a lado no trace
+            with tracing.span(f"{self.name} {op}", kind=tracing.CLIENT, attempt=attempt + 1) as span:
+                try:
+                    result = await asyncio.wait_for(fn(*args, **kwargs), remaining(budget_s))
+                except asyncio.CancelledError:
+                    self.breaker.cancel()
+                    raise
+                except self.transient as e:
+                    if isinstance(e, asyncio.TimeoutError) and _expired():
+                        # estourou o deadline do request, não o timeout do destino
+                        self.breaker.cancel()
+                        metrics.outbound_errors.inc(self.name, op, "deadline")
+                        raise DeadlineExceeded("request deadline exceeded") from e
+                    self.breaker.record(False)
+                    metrics.outbound_latency.observe(time.perf_counter() - t0, self.name, op)
+                    metrics.outbound_errors.inc(self.name, op, type(e).__name__)
+                    span.error = f"{type(e).__name__}: {e}"
+                    error, result = e, None
+                except Exception:
+                    # erro de negócio (4xx, validação…): o destino respondeu
+                    self.breaker.record(True)
+                    metrics.outbound_latency.observe(time.perf_counter() - t0, self.name, op)
+                    raise
+                else:
+                    metrics.outbound_latency.observe(time.perf_counter() - t0, self.name, op)
+                    status = getattr(result, "status_code", None)
+                    if status is not None:
+                        span.set("http.status_code", status)
+                    if not self._failed(result):
+                        self.breaker.record(True)
+                        return result
+                    self.breaker.record(False)
+                    metrics.outbound_errors.inc(self.name, op, f"http_{result.status_code}")
+                    span.error = f"HTTP {result.status_code}"
+                    error = None
+
+            attempt += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            if (not idempotent or attempt > self.retries
+                    or _expired(delay) or not self.budget.withdraw()):
+                if error is not None:
+                    raise error
+                return result
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            **self.breaker.stats(),
+            "total":         self.calls,
+            "retried":       self.retried,
+            "rejected":      self.rejected,
+            "budget_tokens": round(self.budget.tokens, 2),
+        }
@@ -0,0 +1,29 @@
+import os
+import sqlite3
+
+# Estado local (outbox, índices, caches persistentes) em SQLite com WAL.
+# Uma conexão por arquivo, usada só pela thread do event loop.
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+_conns: dict[str, sqlite3.Connection] = {}
+
+
+def connect(name: str) -> sqlite3.Connection:
+    conn = _conns.get(name)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(
+            os.path.join(DATA_DIR, f"{name}.db"),
+            isolation_level=None,          # autocommit; transações explícitas quando precisar
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _conns[name] = conn
+    return conn
+
+
+def close_all():
+    for conn in _conns.values():
+        conn.close()
+    _conns.clear()
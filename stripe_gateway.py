@@ -0,0 +1,158 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+
+from admission import AdmissionController
+from resilience import Dependency, TRANSIENT
+
+# Todo acesso ao Stripe passa por aqui: controle de admissão (taxa/prioridade),
+# métodos *_async do SDK com cliente httpx em pool, ou (SDK antigo /
+# STRIPE_ASYNC=0) um thread-pool limitado.
+# Cada gateway tem seu próprio StripeClient, então ninguém mexe no
+# stripe.api_key global.
+STRIPE_ASYNC               = os.getenv("STRIPE_ASYNC", "1") == "1"
+STRIPE_THREADS             = int(os.getenv("STRIPE_THREADS", "8"))
+STRIPE_TIMEOUT             = float(os.getenv("STRIPE_TIMEOUT", "20"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "1"))
+# outro host p/ a API (ex.: o fake do bench/); vazio = api.stripe.com
+STRIPE_API_BASE            = os.getenv("STRIPE_API_BASE", "")
+
+# orçamento (segundos) por chamada; o que não estiver aqui usa STRIPE_TIMEOUT
+STRIPE_TIMEOUTS = {
+    "checkout.sessions.create":   8.0,
+    "checkout.sessions.retrieve": 5.0,
+    "prices.retrieve":            4.0,
+    "customers.retrieve":         4.0,
+    "customers.create":           6.0,
+    "customers.update":           6.0,
+    "payment_intents.create":     8.0,
+    "payment_intents.retrieve":   5.0,
+}
+
+
+# erros do Stripe que indicam destino doente (rede, 429, 5xx); o resto
+# (cartão recusado, parâmetro inválido) é resposta válida
+STRIPE_TRANSIENT = TRANSIENT + (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError)
+
+# leituras podem ser repetidas; escritas só com idempotency_key
+_IDEMPOTENT = ("retrieve", "list", "search")
+
+
+def to_plain(obj) -> dict:
+    # StripeObject deixou de ser dict nas versões novas do SDK
+    if obj is None:
+        return {}
+    to_dict = getattr(obj, "to_dict", None)
+    return to_dict() if callable(to_dict) else dict(obj)
+
+
+def object_id(obj):
+    # campo que pode vir como id ou como objeto expandido
+    if obj is None or isinstance(obj, str):
+        return obj
+    return obj["id"]
+
+
+class StripeGateway:
+    def __init__(self, api_key: str,
+                 timeouts: dict = None,
+                 use_async: bool = STRIPE_ASYNC,
+                 threads: int = STRIPE_THREADS,
+                 base_addresses: dict = None,
+                 dependency: Dependency = None,
+                 admission: AdmissionController = None,
+                 name: str = "stripe"):
+        self.api_key = api_key
+        self.timeouts = {**STRIPE_TIMEOUTS, **(timeouts or {})}
+        self.use_async = use_async
+        self.threads = threads
+        self.base_addresses = base_addresses or ({"api": STRIPE_API_BASE} if STRIPE_API_BASE else {})
+        self.dependency = dependency or Dependency(name, STRIPE_TIMEOUT, transient=STRIPE_TRANSIENT)
+        self.admission = admission or AdmissionController()
+        self._client = None
+        self._http_client = None
+        self._executor = None
+        self._last_call = None      # time.monotonic() da última resposta
+
+    @property
+    def client(self) -> stripe.StripeClient:
+        # criado sob demanda: sem STRIPE_SECRET_KEY o app ainda sobe
+        if self._client is None:
+            if self.use_async:
+                self._http_client = stripe.HTTPXClient(allow_sync_methods=True)
+            self._client = stripe.StripeClient(
+                self.api_key,
+                http_client=self._http_client,
+                max_network_retries=STRIPE_MAX_NETWORK_RETRIES,
+                base_addresses=self.base_addresses,
+            )
+        return self._client
+
+    def _resolve(self, method: str):
+        *path, name = method.split(".")
+        service = getattr(self.client, "v1", self.client)
+        for part in path:
+            service = getattr(service, part)
+        return service, name
+
+    def prepare(self):
+        # monta o StripeClient e os services (imports preguiçosos do SDK, ~150ms)
+        # no startup em vez de no primeiro checkout
+        for method in self.timeouts:
+            self._resolve(method)
+
+    async def call(self, method: str, *args, timeout: float = None, **kwargs):
+        # ex.: await gw.call("prices.retrieve", price_id)
+        service, name = self._resolve(method)
+        budget = timeout if timeout is not None else self.timeouts.get(method, STRIPE_TIMEOUT)
+        idempotent = name in _IDEMPOTENT or "idempotency_key" in (kwargs.get("options") or {})
+
+        async_fn = getattr(service, name + "_async", None) if self.use_async else None
+        if async_fn is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="stripe")
+            sync_fn = functools.partial(getattr(service, name), *args, **kwargs)
+
+        async def attempt():
+            try:
+                if async_fn is not None:
+                    return await async_fn(*args, **kwargs)
+                return await asyncio.get_running_loop().run_in_executor(self._executor, sync_fn)
+            except stripe.RateLimitError:
+                self.admission.throttled()
+                raise
+            finally:
+                self._last_call = time.monotonic()
+
+        # fila de admissão (pode recusar com Overloaded); depois timeout/deadline,
+        # retry e breaker ficam na Dependency
+        await self.admission.acquire()
+        return await self.dependency.call(attempt, timeout=budget, idempotent=idempotent, op=method)
+
+    def idle_for(self) -> float:
+        # segundos desde a última chamada ao Stripe (infinito se nunca houve)
+        return float("inf") if self._last_call is None else time.monotonic() - self._last_call
+
+    async def paginate(self, method: str, params: dict = None, **kwargs):
+        # auto-paginação página a página (memória constante), passando por
+        # call() p/ manter timeout e o mesmo caminho async/thread-pool
+        params = dict(params or {})
+        while True:
+            page = await self.call(method, params=params, **kwargs)
+            data = page["data"]
+            for obj in data:
+                yield obj
+            if not page["has_more"] or not data:
+                return
+            params["starting_after"] = data[-1]["id"]
+
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.close_async()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._client = self._http_client = self._executor = None
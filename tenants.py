@@ -0,0 +1,149 @@
+import contextlib
+import contextvars
+import os
+
+from fastapi.responses import JSONResponse
+
+# Várias lojas num processo só. Cada loja (tenant) tem suas credenciais e seus
+# recursos: cliente Stripe (pool, admissão e breaker próprios), catálogo,
+# caches, outbox, inboxes… O tenant do request vai num contextvar, como o
+# deadline e a prioridade, e as tasks criadas a partir dele herdam.
+#
+#   TENANTS=loja2,loja3
+#   LOJA2_STRIPE_SECRET_KEY, LOJA2_STRIPE_WEBHOOK_SECRET, LOJA2_PIXEL_ID,
+#   LOJA2_ACCESS_TOKEN, LOJA2_UTMIFY_API_KEY, LOJA2_ORIGINS, LOJA2_HOSTS
+#
+# Sem prefixo (STRIPE_SECRET_KEY…) é o tenant "default", que atende tudo o
+# que não casar com outro. Roteamento, nessa ordem:
+#   /t/<tenant>/...   (ex.: endpoint do webhook no Stripe: /t/loja2/webhook)
+#   Origin            (checkout/upsell vindos da página da loja)
+#   Host              (domínio próprio apontando p/ cá)
+TENANTS = [name.strip() for name in os.getenv("TENANTS", "").split(",") if name.strip()]
+
+DEFAULT = "default"
+PATH_PREFIX = "/t/"
+
+_current = contextvars.ContextVar("tenant", default=None)
+
+
+def _split(value: str) -> list:
+    return [v.strip().rstrip("/") for v in (value or "").split(",") if v.strip()]
+
+
+class Tenant:
+    def __init__(self, name: str, env_prefix: str = ""):
+        self.name = name
+        # sufixo das tabelas/bancos locais; o default mantém os nomes de antes
+        self.suffix = "" if name == DEFAULT else "_" + name
+        self.stripe_secret_key = os.getenv(env_prefix + "STRIPE_SECRET_KEY")
+        self.webhook_secret    = os.getenv(env_prefix + "STRIPE_WEBHOOK_SECRET")
+        self.pixel_id          = os.getenv(env_prefix + "PIXEL_ID")
+        self.access_token      = os.getenv(env_prefix + "ACCESS_TOKEN")
+        self.utmify_api_key    = os.getenv(env_prefix + "UTMIFY_API_KEY")
+        self.origins           = _split(os.getenv(env_prefix + "ORIGINS"))
+        self.hosts             = [h.lower() for h in _split(os.getenv(env_prefix + "HOSTS"))]
+        # recursos (stripe_gw, catalog, outbox…) são montados pelo main.py
+
+    def __repr__(self):
+        return f"<Tenant {self.name}>"
+
+
+class TenantLocal:
+    # atributo do tenant do contexto atual, p/ o main.py seguir usando
+    # stripe_gw/catalog/outbox… como nomes de módulo
+    __slots__ = ("_registry", "_attr")
+
+    def __init__(self, registry, attr: str):
+        object.__setattr__(self, "_registry", registry)
+        object.__setattr__(self, "_attr", attr)
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._registry.current(), self._attr), name)
+
+    def __setattr__(self, name, value):
+        setattr(getattr(self._registry.current(), self._attr), name, value)
+
+    def __repr__(self):
+        return f"<{self._attr} de {self._registry.current().name}>"
+
+
+class TenantRegistry:
+    def __init__(self, names: list = TENANTS):
+        self.default = Tenant(DEFAULT)
+        self.by_name = {DEFAULT: self.default}
+        for name in names:
+            self.by_name[name] = Tenant(name, name.upper().replace("-", "_") + "_")
+        self._by_origin = {o: t for t in self for o in t.origins}
+        self._by_host = {h: t for t in self for h in t.hosts}
+
+    def __iter__(self):
+        return iter(list(self.by_name.values()))
+
+    def get(self, name: str):
+        return self.by_name.get(name)
+
+    def current(self) -> Tenant:
+        return _current.get() or self.default
+
+    def local(self, attr: str) -> TenantLocal:
+        return TenantLocal(self, attr)
+
+    @contextlib.contextmanager
+    def active(self, tenant: Tenant):
+        # tasks criadas aqui dentro ficam com o tenant
+        token = _current.set(tenant)
+        try:
+            yield tenant
+        finally:
+            _current.reset(token)
+
+    def bind(self, tenant: Tenant, fn):
+        # async fn que roda no tenant, chamada de fora de um request (warm-up)
+        async def bound(*args, **kwargs):
+            _current.set(tenant)
+            return await fn(*args, **kwargs)
+        return bound
+
+    def allows_origin(self, origin: str) -> bool:
+        return origin in self._by_origin
+
+    def resolve(self, scope) -> Tenant:
+        # None = /t/<tenant> desconhecido
+        path = scope["path"]
+        if path.startswith(PATH_PREFIX):
+            name, _, rest = path[len(PATH_PREFIX):].partition("/")
+            tenant = self.by_name.get(name)
+            if tenant is not None:
+                # o app vê o path sem o prefixo
+                scope["path"] = "/" + rest
+                scope["raw_path"] = scope["path"].encode()
+            return tenant
+        origin = host = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value.decode("latin-1").rstrip("/")
+            elif name == b"host":
+                host = value.decode("latin-1").split(":")[0].lower()
+        return self._by_origin.get(origin) or self._by_host.get(host) or self.default
+
+    def stats(self) -> dict:
+        return {t.name: {"origins": t.origins, "hosts": t.hosts, "stripe": bool(t.stripe_secret_key)} for t in self}
+
+
+class TenantMiddleware:
+    # ASGI puro: escolhe o tenant do request antes de tudo
+    def __init__(self, app, registry: TenantRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        tenant = self.registry.resolve(scope)
+        if tenant is None:
+            return await JSONResponse(status_code=404, content={"error": "unknown tenant"})(scope, receive, send)
+        token = _current.set(tenant)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+# os módulos ficam na raiz do repo; o main.py lê TENANTS e DATA_DIR no import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="checkout-tests-")
+os.environ["TENANTS"] = "loja2"
+
+import pytest
+
+import store
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # bancos SQLite novos por teste; as conexões já abertas (main.py) ficam
+    monkeypatch.setattr(store, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(store, "_conns", {})
+    yield tmp_path
+    for conn in store._conns.values():
+        conn.close()
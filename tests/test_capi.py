@@ -0,0 +1,54 @@
+import asyncio
+
+import httpx
+import pytest
+
+from capi import CapiBatcher, CapiError
+from outbox import PermanentDeliveryError
+
+
+def _post(batches: list, status: int = 200):
+    async def post(events):
+        batches.append(list(events))
+        if status != 200:
+            return httpx.Response(status, text="erro")
+        if any(b"bad" in event for event in events):
+            return httpx.Response(400, text="Invalid parameter")
+        return httpx.Response(200, text="{}")
+    return post
+
+
+def test_bad_event_is_isolated_by_bisecting(data_dir):
+    batches = []
+    batcher = CapiBatcher(_post(batches), flush_interval=0.01)
+    events = [b"ok1", b"ok2", b"bad", b"ok3"]
+
+    async def run():
+        return await asyncio.gather(
+            *(batcher.send(f"Purchase:{e.decode()}", e) for e in events), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert results[:2] == [None, None] and results[3] is None
+    assert isinstance(results[2], PermanentDeliveryError)
+    assert batches[0] == events
+    assert [b"bad"] in batches
+    assert batcher.splits == 2
+    assert batcher.events == 3
+
+
+def test_server_error_is_transient(data_dir):
+    batcher = CapiBatcher(_post([], status=503), flush_interval=0.01)
+    with pytest.raises(CapiError):
+        asyncio.run(batcher.send("Purchase:cs_1", b"evt"))
+
+
+def test_same_key_is_sent_once(data_dir):
+    batches = []
+    batcher = CapiBatcher(_post(batches), flush_interval=0.01)
+
+    async def run():
+        await asyncio.gather(batcher.send("Purchase:cs_1", b"a"), batcher.send("Purchase:cs_1", b"a"))
+
+    asyncio.run(run())
+    assert batches == [[b"a"]] and batcher.deduped == 1
@@ -0,0 +1,82 @@
+import asyncio
+
+import inbox
+from inbox import Inbox
+
+
+async def _drain(box: Inbox, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while box.stats()["pending"]:
+        assert asyncio.get_running_loop().time() < deadline, box.stats()
+        await asyncio.sleep(0.01)
+
+
+def test_same_key_waits_for_retry(data_dir, monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_BASE_DELAY", 0.05)
+    seen = []
+    failures = {b"a1": 2}
+
+    async def handler(type, payload):
+        if failures.get(payload):
+            failures[payload] -= 1
+            raise RuntimeError("destino fora")
+        seen.append(payload)
+
+    async def run():
+        box = Inbox("test", handler, workers=4)
+        box.start()
+        for payload in (b"a1", b"a2", b"a3"):
+            box.put("evt", "cus_a", payload)
+        box.put("evt", "cus_b", b"b1")
+        await _drain(box)
+        await box.stop()
+        return box
+
+    box = asyncio.run(run())
+    # a1 falhou duas vezes e ainda assim saiu antes de a2/a3
+    assert [p for p in seen if p.startswith(b"a")] == [b"a1", b"a2", b"a3"]
+    # outra chave não fica presa atrás do retry
+    assert seen.index(b"b1") < seen.index(b"a1")
+    assert box.failed == 2 and box.processed == 4
+
+
+def test_dead_job_releases_key(data_dir, monkeypatch):
+    monkeypatch.setattr(inbox, "INBOX_BASE_DELAY", 0.01)
+    seen = []
+
+    async def handler(type, payload):
+        if payload == b"bad":
+            raise RuntimeError("sempre falha")
+        seen.append(payload)
+
+    async def run():
+        box = Inbox("test", handler, workers=2, max_attempts=2)
+        box.start()
+        box.put("evt", "cus_a", b"bad")
+        box.put("evt", "cus_a", b"next")
+        await _drain(box)
+        await box.stop()
+        return box
+
+    box = asyncio.run(run())
+    assert seen == [b"next"]
+    assert box.stats()["dead"] == 1
+
+
+def test_pending_rows_replay_in_order_after_restart(data_dir):
+    seen = []
+
+    async def handler(type, payload):
+        seen.append(payload)
+
+    async def run():
+        # gravado sem workers (processo caiu antes de processar)
+        Inbox("test", handler).put("evt", "cus_a", b"1")
+        Inbox("test", handler).put("evt", "cus_a", b"2")
+        box = Inbox("test", handler, workers=3)
+        box.start()
+        await _drain(box)
+        await box.stop()
+
+    asyncio.run(run())
+    assert seen == [b"1", b"2"]
@@ -0,0 +1,43 @@
+import time
+
+from kv import KVCache
+
+
+def test_get_keeps_expired_rows(data_dir):
+    cache = KVCache("items", ttl=60)
+    cache.set("fresh", {"v": 1})
+    cache.set("old", {"v": 2}, ttl=0.01)
+    time.sleep(0.02)
+
+    assert cache.get("old") is None
+    # um KVCache novo (sem a memória na frente) também não vê, mas a linha
+    # continua lá p/ o sweep
+    assert KVCache("items", ttl=60).get("old") is None
+    assert cache.expired() == [("old", {"v": 2})]
+    assert cache.stats()["rows"] == 2
+
+    cache.purge()
+    assert cache.expired() == []
+    assert cache.get("fresh") == {"v": 1}
+
+
+def test_pop_returns_and_deletes(data_dir):
+    cache = KVCache("items", ttl=60)
+    cache.set("k", {"v": 1})
+    assert cache.pop("k") == {"v": 1}
+    assert cache.get("k") is None
+    assert cache.stats()["rows"] == 0
+
+
+def test_purge_every_zero_leaves_cleanup_to_caller(data_dir):
+    cache = KVCache("items", ttl=0.01, purge_every=1)
+    cache.set("a", {"v": 1})
+    time.sleep(0.02)
+    cache.set("b", {"v": 2})
+    assert [key for key, _ in cache.expired()] == []
+
+    swept = KVCache("swept", ttl=0.01, purge_every=0)
+    swept.set("a", {"v": 1})
+    time.sleep(0.02)
+    swept.set("b", {"v": 2})
+    assert [key for key, _ in swept.expired()] == ["a"]
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from outbox import Outbox, PermanentDeliveryError
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+async def _wait(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def _row(box: Outbox):
+    return box.conn.execute("SELECT attempts, next_attempt_at, state FROM outbox").fetchone()
+
+
+def test_failed_delivery_is_retried(data_dir):
+    calls = []
+
+    async def send(body, key):
+        calls.append(body)
+        if len(calls) == 1:
+            raise RuntimeError("timeout")
+
+    async def run():
+        box = Outbox({"capi": send}, base_delay=0.02)
+        box.start()
+        box.enqueue("capi", b"evt", "Purchase:cs_1")
+        await _wait(lambda: box.delivered)
+        await box.stop()
+        return box
+
+    box = asyncio.run(run())
+    assert calls == [b"evt", b"evt"]
+    assert box.failed == 1 and box.depth() == 0
+    assert box.has("capi", "Purchase:cs_1")
+
+
+def test_permanent_error_goes_dead(data_dir):
+    async def send(body, key):
+        raise PermanentDeliveryError("rejected")
+
+    async def run():
+        box = Outbox({"capi": send})
+        return box, await box.deliver("capi", b"evt", "Purchase:cs_1")
+
+    box, ok = asyncio.run(run())
+    assert ok is False
+    assert _row(box)[0] == 1 and _row(box)[2] == "dead"
+    assert not box.has("capi", "Purchase:cs_1")
+
+
+def test_open_breaker_defers_without_attempt(data_dir):
+    calls = []
+
+    async def send(body, key):
+        calls.append(body)
+
+    breaker = CircuitBreaker("utmify", open_for=30)
+    breaker._trip(time.monotonic())
+
+    async def run():
+        box = Outbox({"utmify": send}, breakers={"utmify": breaker})
+        return box, await box.deliver("utmify", b"order", "cs_1:paid")
+
+    box, ok = asyncio.run(run())
+    attempts, next_attempt_at, state = _row(box)
+    assert ok is False and calls == []
+    assert box.deferred == 1
+    assert attempts == 0 and state == "pending"
+    assert next_attempt_at > time.time() + 20
+
+
+def test_circuit_open_from_sender_defers(data_dir):
+    async def send(body, key):
+        raise CircuitOpenError("capi", 10)
+
+    async def run():
+        box = Outbox({"capi": send})
+        return box, await box.deliver("capi", b"evt", "Purchase:cs_1")
+
+    box, ok = asyncio.run(run())
+    attempts, next_attempt_at, state = _row(box)
+    assert ok is False and box.failed == 0 and box.deferred == 1
+    assert attempts == 0 and state == "pending"
+    assert next_attempt_at > time.time() + 5
+
+
+def test_slow_kind_does_not_block_others(data_dir):
+    delivered = []
+
+    async def slow(body, key):
+        await asyncio.sleep(1)
+        delivered.append(body)
+
+    async def fast(body, key):
+        delivered.append(body)
+
+    async def run():
+        box = Outbox({"utmify": slow, "capi": fast})
+        box.start()
+        box.enqueue("utmify", b"order", "cs_1:paid")
+        await asyncio.sleep(0.1)
+        box.enqueue("capi", b"evt", "Purchase:cs_1")
+        await _wait(lambda: b"evt" in delivered, timeout=0.5)
+        await box.stop()
+
+    asyncio.run(run())
+    assert delivered == [b"evt"]
@@ -0,0 +1,81 @@
+import asyncio
+import urllib.parse
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def paypal(monkeypatch):
+    # _notify-validate e os side effects falsos; record falha enquanto fail > 0
+    state = {"verify": "VERIFIED", "fail": 0, "recorded": []}
+
+    async def call(fn, *args, **kwargs):
+        return httpx.Response(200, text=state["verify"], request=httpx.Request("POST", main.PAYPAL_IPN_URL))
+
+    async def record(form):
+        if state["fail"]:
+            state["fail"] -= 1
+            raise RuntimeError("UTMify fora")
+        state["recorded"].append((main.tenants.current().name, form["txn_id"], form["payment_status"]))
+
+    monkeypatch.setattr(main.dependencies["paypal"], "call", call)
+    monkeypatch.setattr(main, "record_paypal_ipn", record)
+    return state
+
+
+def _process(tenant: str, txn_id: str, status: str = "Completed"):
+    form = {"txn_id": txn_id, "payment_status": status}
+    raw = urllib.parse.urlencode(form).encode()
+
+    async def run():
+        with main.tenants.active(main.tenants.get(tenant)):
+            await main.process_paypal_ipn(raw, form, main.paypal_dedup_key(form))
+
+    asyncio.run(run())
+
+
+def test_key_is_per_tenant_and_status():
+    form = {"txn_id": "T1", "payment_status": "Completed"}
+    with main.tenants.active(main.tenants.get("default")):
+        default = main.paypal_dedup_key(form)
+        refunded = main.paypal_dedup_key({**form, "payment_status": "Refunded"})
+    with main.tenants.active(main.tenants.get("loja2")):
+        other = main.paypal_dedup_key(form)
+    assert len({default, refunded, other}) == 3
+
+
+def test_same_txn_processed_once_per_tenant(paypal):
+    _process("default", "T-tenants")
+    _process("loja2", "T-tenants")
+    _process("default", "T-tenants")
+    _process("loja2", "T-tenants")
+    assert paypal["recorded"] == [("default", "T-tenants", "Completed"), ("loja2", "T-tenants", "Completed")]
+
+
+def test_failure_releases_only_its_tenant(paypal):
+    _process("loja2", "T-release")
+    paypal["fail"] = 1
+    with pytest.raises(RuntimeError):
+        _process("default", "T-release")
+    # o retry do inbox passa de novo no default; o loja2 continua duplicado
+    _process("default", "T-release")
+    _process("loja2", "T-release")
+    assert paypal["recorded"] == [("loja2", "T-release", "Completed"), ("default", "T-release", "Completed")]
+
+
+def test_invalid_ipn_does_not_claim(paypal):
+    paypal["verify"] = "INVALID"
+    _process("default", "T-forged")
+    paypal["verify"] = "VERIFIED"
+    _process("default", "T-forged")
+    assert paypal["recorded"] == [("default", "T-forged", "Completed")]
+
+
+def test_new_status_is_not_a_duplicate(paypal):
+    _process("default", "T-status", "Pending")
+    _process("default", "T-status", "Completed")
+    _process("default", "T-status", "Completed")
+    assert [status for _, _, status in paypal["recorded"]] == ["Pending", "Completed"]
@@ -0,0 +1,251 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import sys
+import time
+
+from models import dumps
+
+# Tracing leve: um span por request (raiz), por fase dos handlers e por
+# chamada externa (Dependency.call: Stripe, CAPI, UTMify, PayPal). O span
+# atual vai num contextvar, como o deadline, e as tasks criadas dentro dele
+# herdam. Os prints feitos dentro de um span saem com [trace=...], e o
+# trace id volta no header X-Trace-Id.
+#
+# Export: TRACE_FILE recebe uma linha JSON por lote no formato OTLP/JSON
+# (ExportTraceServiceRequest), o mesmo do file exporter do OpenTelemetry
+# Collector. Sem TRACE_FILE os spans só servem p/ os ids nos logs.
+TRACE_FILE        = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE      = float(os.getenv("TRACE_SAMPLE", "1.0"))      # fração dos traces exportados
+TRACE_FLUSH_EVERY = float(os.getenv("TRACE_FLUSH_EVERY", "2"))
+TRACE_BUFFER_MAX  = int(os.getenv("TRACE_BUFFER_MAX", "20000"))  # spans; acima disso descarta
+TRACE_SERVICE     = os.getenv("TRACE_SERVICE", "stripe-checkout-backend")
+TRACE_LOG_IDS     = os.getenv("TRACE_LOG_IDS", "1") == "1"
+
+# kinds do OTLP
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_span = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end",
+                 "attributes", "error", "sampled")
+
+    def __init__(self, name: str, kind: int, trace_id: str, parent_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = {}
+        self.error = None
+        self.sampled = sampled
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        out = {
+            "traceId":           self.trace_id,
+            "spanId":            self.span_id,
+            "name":              self.name,
+            "kind":              self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano":   str(self.end),
+            "attributes":        [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status":            {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            out["parentSpanId"] = self.parent_id
+        return out
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def parse_traceparent(header: str):
+    # W3C: 00-<trace id 32 hex>-<span id 16 hex>-<flags>; None se inválido
+    parts = (header or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = INTERNAL, remote: tuple = None, **attributes):
+    # remote: (trace_id, parent span id, sampled) vindo de um traceparent
+    parent = _span.get()
+    if parent is not None:
+        current = Span(name, kind, parent.trace_id, parent.span_id, parent.sampled)
+    elif remote is not None:
+        current = Span(name, kind, remote[0], remote[1], remote[2] or random.random() < TRACE_SAMPLE)
+    else:
+        current = Span(name, kind, os.urandom(16).hex(), None, random.random() < TRACE_SAMPLE)
+    current.attributes.update(attributes)
+    token = _span.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.error = "cancelled"
+        raise
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = time.time_ns()
+        _span.reset(token)
+        exporter.record(current)
+
+
+def detach():
+    # p/ tasks de background criadas dentro de um request (lote de vários
+    # requests): o trabalho delas começa um trace próprio
+    _span.set(None)
+
+
+def trace_id():
+    current = _span.get()
+    return current.trace_id if current is not None else None
+
+
+class TraceExporter:
+    def __init__(self, path: str = TRACE_FILE, flush_every: float = TRACE_FLUSH_EVERY,
+                 max_buffer: int = TRACE_BUFFER_MAX):
+        self.path = path
+        self.flush_every = flush_every
+        self.max_buffer = max_buffer
+        self.exported = 0
+        self.dropped = 0
+        self._buffer = []
+        self._task = None
+
+    def record(self, current: Span):
+        if not self.path or not current.sampled:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer.append(current)
+
+    def start(self):
+        if self.path and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_every)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("→ Traces: export falhou:", e)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        spans, self._buffer = self._buffer, []
+        line = dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [s.to_otlp() for s in spans]}],
+        }]})
+        # escrita em disco fora do event loop
+        await asyncio.to_thread(self._write, line)
+        self.exported += len(spans)
+
+    def _write(self, line: bytes):
+        with open(self.path, "ab") as f:
+            f.write(line + b"\n")
+
+    def stats(self) -> dict:
+        return {"path": self.path or None, "sample": TRACE_SAMPLE, "buffered": len(self._buffer),
+                "exported": self.exported, "dropped": self.dropped}
+
+
+exporter = TraceExporter()
+
+
+class TraceLogStream:
+    # envolve o stdout: cada linha de print() feita dentro de um span sai
+    # com o trace id na frente
+    def __init__(self, stream):
+        self.stream = stream
+        self._line_start = True
+
+    def write(self, s: str):
+        current = _span.get()
+        if current is not None and s:
+            prefix = f"[trace={current.trace_id}] "
+            body, nl = (s[:-1], "\n") if s.endswith("\n") else (s, "")
+            s = (prefix if self._line_start else "") + body.replace("\n", "\n" + prefix) + nl
+        if s:
+            self._line_start = s.endswith("\n")
+        return self.stream.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install_log_ids():
+    if TRACE_LOG_IDS and not isinstance(sys.stdout, TraceLogStream):
+        sys.stdout = TraceLogStream(sys.stdout)
+
+
+def uninstall_log_ids():
+    if isinstance(sys.stdout, TraceLogStream):
+        sys.stdout = sys.stdout.stream
+
+
+class TracingMiddleware:
+    # ASGI puro: span raiz do request (continua o traceparent de quem chamou)
+    # e X-Trace-Id na resposta
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        remote = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                remote = parse_traceparent(value.decode("latin-1"))
+                break
+        status = [500]
+
+        with span(f"{scope['method']} {scope['path']}", kind=SERVER, remote=remote) as root:
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    status[0] = message["status"]
+                    # lista nova: a Response pode ser compartilhada (single-flight)
+                    message = {**message, "headers": [*message.get("headers", ()),
+                                                      (b"x-trace-id", root.trace_id.encode())]}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    root.name = f"{scope['method']} {route.path}"
+                root.set("http.method", scope["method"])
+                root.set("http.target", scope["path"])
+                root.set("http.status_code", status[0])
+                if status[0] >= 500 and root.error is None:
+                    root.error = f"HTTP {status[0]}"
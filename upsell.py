@@ -0,0 +1,92 @@
+import asyncio
+import os
+
+from admission import set_priority, BACKGROUND
+from kv import KVCache
+
+# PaymentIntents de upsell pré-criados no checkout.session.completed, p/ o
+# /upsell/intent responder só com o client_secret guardado. O que não for
+# usado dentro da janela é cancelado pelo sweep. Chave que o /upsell/intent
+# já entregou ao comprador fica marcada (served) e o sweep não cancela.
+UPSELL_INTENT_WINDOW = float(os.getenv("UPSELL_INTENT_WINDOW", "1800"))
+UPSELL_SWEEP_EVERY   = float(os.getenv("UPSELL_SWEEP_EVERY", "60"))
+
+# estados em que ninguém confirmou o intent ainda (requires_action = comprador
+# no meio do 3DS, não entra)
+_UNUSED = ("requires_payment_method", "requires_confirmation")
+
+
+def idempotency_key(sid: str, price_id: str, quantity: int) -> str:
+    return f"upsell:{sid}:{price_id}:{quantity}"
+
+
+class UpsellPrefetcher:
+    def __init__(self, gateway, window: float = UPSELL_INTENT_WINDOW,
+                 sweep_every: float = UPSELL_SWEEP_EVERY, table: str = "upsell_intents"):
+        self.gateway = gateway
+        self.window = window
+        self.sweep_every = sweep_every
+        # vencidos ficam até o sweep cancelar o intent no Stripe
+        self.intents = KVCache(table, ttl=window, purge_every=0)
+        self.hits = 0
+        self.cancelled = 0
+        self._task = None
+
+    def take(self, sid: str, price_id: str, quantity: int):
+        # o comprador vai usar o intent desta chave (o pré-criado ou, pela
+        # mesma idempotency key, o que o endpoint criar): marca como entregue
+        # p/ o sweep não cancelar; vale também p/ linha vencida ou ausente
+        key = idempotency_key(sid, price_id, quantity)
+        found = self.intents.get(key)
+        self.intents.set(key, {**(found or {}), "served": True})
+        if found is not None and "client_secret" in found:
+            self.hits += 1
+            return found
+        return None
+
+    def store(self, sid: str, price_id: str, quantity: int, intent):
+        key = idempotency_key(sid, price_id, quantity)
+        if (self.intents.get(key) or {}).get("served"):
+            # o endpoint chegou antes: é o mesmo intent e já está com o comprador
+            return
+        self.intents.set(key, {
+            "intent_id":     intent.id,
+            "client_secret": intent.client_secret,
+        })
+
+    async def sweep(self):
+        for key, entry in self.intents.expired():
+            if entry.get("served"):
+                self.intents.pop(key)
+                continue
+            try:
+                intent = await self.gateway.call("payment_intents.retrieve", entry["intent_id"])
+                if intent.status in _UNUSED:
+                    await self.gateway.call("payment_intents.cancel", entry["intent_id"])
+                    self.cancelled += 1
+            except Exception as e:
+                print("→ Upsell sweep erro:", entry["intent_id"], e)
+                continue
+            self.intents.pop(key)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        set_priority(BACKGROUND)
+        while True:
+            await asyncio.sleep(self.sweep_every)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print("→ Upsell sweep erro:", e)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "cancelled": self.cancelled, **self.intents.stats()}
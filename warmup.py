@@ -0,0 +1,94 @@
+import asyncio
+import os
+import time
+
+# Aquecimento depois de um restart: abre as conexões com Stripe/Graph/UTMify/
+# PayPal e carrega preços/funis antes do primeiro comprador. /ready só fica
+# verde quando todos os passos com required=True deram certo; os outros
+# (hosts de tracking, que o checkout não espera) rodam e aparecem nos
+# resultados sem segurar o /ready. Passo que falhou tenta de novo a cada
+# WARMUP_RETRY_EVERY. Com WARMUP_READY_ON_TIMEOUT=1 o /ready fica verde
+# depois de WARMUP_TIMEOUT mesmo sem tudo quente, marcado como "degraded".
+# /health continua sendo só "o processo está de pé". Depois disso os passos
+# com keep=True se repetem a cada KEEPWARM_EVERY p/ o keep-alive não expirar
+# nas horas paradas.
+WARMUP_TIMEOUT          = float(os.getenv("WARMUP_TIMEOUT", "20"))
+WARMUP_RETRY_EVERY      = float(os.getenv("WARMUP_RETRY_EVERY", "5"))
+WARMUP_READY_ON_TIMEOUT = os.getenv("WARMUP_READY_ON_TIMEOUT", "0") == "1"
+KEEPWARM_EVERY          = float(os.getenv("KEEPWARM_EVERY", "30"))     # s; abaixo do HTTP_KEEPALIVE_EXPIRY; 0 = desliga
+
+
+class Warmup:
+    def __init__(self, timeout: float = WARMUP_TIMEOUT, keepwarm_every: float = KEEPWARM_EVERY,
+                 retry_every: float = WARMUP_RETRY_EVERY, ready_on_timeout: bool = WARMUP_READY_ON_TIMEOUT):
+        self.timeout = timeout
+        self.keepwarm_every = keepwarm_every
+        self.retry_every = retry_every
+        self.ready_on_timeout = ready_on_timeout
+        self.steps = {}             # nome -> (async fn, keep, required)
+        self.results = {}
+        self.ready = False
+        self.degraded = False       # pronto pelo timeout, com passo falhando
+        self.started_at = None
+        self.ready_in = None
+        self._task = None
+
+    def step(self, name: str, fn, keep: bool = False, required: bool = True):
+        self.steps[name] = (fn, keep, required)
+
+    async def _timed(self, name: str, fn):
+        t0 = time.perf_counter()
+        required = self.steps[name][2]
+        try:
+            await fn()
+            self.results[name] = {"ok": True, "ms": round((time.perf_counter() - t0) * 1000, 1), "required": required}
+        except Exception as e:
+            self.results[name] = {"ok": False, "ms": round((time.perf_counter() - t0) * 1000, 1),
+                                  "required": required, "error": str(e)}
+
+    def start(self):
+        if self._task is None:
+            self.started_at = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _warm(self, tasks: dict) -> bool:
+        return all(task.done() and self.results[name]["ok"]
+                   for name, task in tasks.items() if self.steps[name][2])
+
+    def _mark_ready(self, degraded: bool):
+        self.ready = True
+        self.degraded = degraded
+        self.ready_in = round(time.monotonic() - self.started_at, 3)
+        print(f"→ {'Pronto sem aquecer tudo' if degraded else 'Aquecido'} em {self.ready_in}s:", self.results)
+
+    async def _run(self):
+        tasks = {name: asyncio.create_task(self._timed(name, fn)) for name, (fn, _, _) in self.steps.items()}
+        gating = [task for name, task in tasks.items() if self.steps[name][2]]
+        if gating:
+            await asyncio.wait(gating, timeout=self.timeout)
+        for name, (_, _, required) in self.steps.items():
+            self.results.setdefault(name, {"ok": False, "required": required, "error": "pending"})
+        # passo que falhou tenta de novo; passo lento continua rodando
+        while not self._warm(tasks):
+            if (self.ready_on_timeout and not self.ready
+                    and time.monotonic() - self.started_at >= self.timeout):
+                self._mark_ready(degraded=True)
+            await asyncio.sleep(self.retry_every)
+            for name, task in tasks.items():
+                if task.done() and not self.results[name]["ok"]:
+                    tasks[name] = asyncio.create_task(self._timed(name, self.steps[name][0]))
+        self._mark_ready(degraded=False)
+
+        keep = [(name, fn) for name, (fn, keep, _) in self.steps.items() if keep]
+        while keep and self.keepwarm_every > 0:
+            await asyncio.sleep(self.keepwarm_every)
+            await asyncio.gather(*(self._timed(name, fn) for name, fn in keep))
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "degraded": self.degraded, "ready_in": self.ready_in, "steps": self.results}